@@ -0,0 +1,161 @@
+"""
+Shared loader for Pico-Saudi-LLMs-Benchmark question files
+Streams questions in chunks from a memory-mapped Parquet cache of the CSV, with category
+and question_id filters pushed down into the scan
+"""
+
+import csv
+import os
+import tempfile
+
+QUESTION_COLUMNS = ['question_id', 'question_category', 'question']
+
+# Bump when the cache layout changes so old caches are rebuilt
+CACHE_VERSION = "1"
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def columnar_cache_path(csv_path):
+    """Where the Parquet cache of a question CSV lives"""
+    directory, name = os.path.split(os.path.abspath(csv_path))
+    return os.path.join(directory, ".cache", os.path.splitext(name)[0] + ".parquet")
+
+def _source_fingerprint(csv_path):
+    """Identify a version of the source CSV without reading it"""
+    stat = os.stat(csv_path)
+    return f"{CACHE_VERSION}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def ensure_columnar_cache(csv_path):
+    """Convert the CSV to Parquet on first read and reuse it until the CSV changes"""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+
+    cache_path = columnar_cache_path(csv_path)
+    fingerprint = _source_fingerprint(csv_path)
+
+    if os.path.exists(cache_path):
+        try:
+            metadata = pq.read_schema(cache_path).metadata or {}
+        except pa.ArrowInvalid:  # Corrupt or truncated cache: rebuild it
+            metadata = {}
+        if metadata.get(b"source_fingerprint") == fingerprint.encode():
+            return cache_path
+
+    print(f"🔄 Building columnar cache for {csv_path}...")
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # Everything stays a string: ids like "5d049" and "01234" must not turn into numbers
+    reader = pacsv.open_csv(
+        csv_path,
+        # Questions may span several lines inside quotes
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            column_types={column: pa.string() for column in QUESTION_COLUMNS},
+            include_columns=QUESTION_COLUMNS,
+        ),
+    )
+    schema = reader.schema.with_metadata({"source_fingerprint": fingerprint})
+
+    # Write to a temporary file of our own so a crash (or another process building the same
+    # cache) never leaves a half-written cache behind
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(cache_path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(cache_path))
+    os.close(fd)
+    rows = 0
+    try:
+        with pq.ParquetWriter(tmp_path, schema, compression="zstd",
+                              use_dictionary=["question_category"]) as writer:
+            for batch in reader:
+                writer.write_table(pa.Table.from_batches([batch], schema=schema))
+                rows += batch.num_rows
+        os.chmod(tmp_path, 0o644)  # mkstemp files are private to their creator
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    print(f"✓ Cached {rows} questions in {cache_path}")
+    return cache_path
+
+def _usable_cache(csv_path):
+    """Path of an up-to-date Parquet cache, or None without pyarrow or when it can't be written"""
+    if not _has_pyarrow() or not os.path.exists(csv_path):
+        return None
+    import pyarrow as pa
+
+    try:
+        return ensure_columnar_cache(csv_path)
+    except (OSError, pa.ArrowInvalid) as e:
+        # e.g. a read-only dataset directory, or a CSV pyarrow can't parse: pandas may still read it
+        print(f"⚠️  Could not build the columnar cache ({e}); parsing the CSV instead")
+        return None
+
+def _scan(cache_path, chunksize, categories, question_ids):
+    """Yield pyarrow record batches from the Parquet cache with filters pushed down"""
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+
+    dataset = ds.dataset(cache_path, format="parquet", filesystem=fs.LocalFileSystem(use_mmap=True))
+
+    expression = None
+    if categories:
+        expression = ds.field("question_category").isin(list(categories))
+    if question_ids:
+        ids = ds.field("question_id").isin([str(qid) for qid in question_ids])
+        expression = ids if expression is None else expression & ids
+
+    for batch in dataset.to_batches(columns=QUESTION_COLUMNS, filter=expression, batch_size=chunksize):
+        if batch.num_rows:
+            yield batch
+
+def iter_question_chunks(csv_path, chunksize=10000, categories=None, question_ids=None):
+    """Yield the questions as pandas DataFrame chunks"""
+    cache_path = _usable_cache(csv_path)
+    if cache_path is not None:
+        for batch in _scan(cache_path, chunksize, categories, question_ids):
+            yield batch.to_pandas()
+        return
+
+    # Without pyarrow (or a cache), fall back to chunked CSV parsing and filter each chunk
+    import pandas as pd
+
+    ids = {str(qid) for qid in question_ids} if question_ids else None
+    for chunk in pd.read_csv(csv_path, usecols=QUESTION_COLUMNS, dtype=str, chunksize=chunksize):
+        if categories:
+            chunk = chunk[chunk['question_category'].isin(categories)]
+        if ids is not None:
+            chunk = chunk[chunk['question_id'].isin(ids)]
+        if len(chunk):
+            yield chunk.reset_index(drop=True)
+
+def iter_question_records(csv_path, chunksize=10000, categories=None, question_ids=None):
+    """Yield the questions one dict at a time (needs neither pandas nor pyarrow)"""
+    cache_path = _usable_cache(csv_path)
+    if cache_path is not None:
+        for batch in _scan(cache_path, chunksize, categories, question_ids):
+            yield from batch.to_pylist()
+        return
+
+    ids = {str(qid) for qid in question_ids} if question_ids else None
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if categories and row['question_category'] not in categories:
+                continue
+            if ids is not None and row['question_id'] not in ids:
+                continue
+            yield {column: row[column] for column in QUESTION_COLUMNS}
+
+def load_questions(csv_path, categories=None, question_ids=None, chunksize=10000):
+    """Load the (filtered) questions into a single DataFrame"""
+    import pandas as pd
+
+    chunks = list(iter_question_chunks(csv_path, chunksize, categories, question_ids))
+    if not chunks:
+        return pd.DataFrame(columns=QUESTION_COLUMNS)
+    return pd.concat(chunks, ignore_index=True)
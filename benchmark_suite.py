@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Offline throughput/scaling benchmark for the benchmark pipeline
+Runs the real run_benchmark loader, scheduler and writer with the model-free MockBackend,
+so it needs no model download or network access
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import gemma3_saudi_benchmark as bench
+from run_benchmark_demo import MockBackend
+
+def load_seed_questions(csv_path):
+    """Load the Pico-Saudi questions, falling back to the ones in the committed demo results"""
+    if not os.path.exists(csv_path):
+        print(f"⚠️  {csv_path} not found, using the questions from gemma3_results_demo.csv")
+        csv_path = "gemma3_results_demo.csv"
+    return pd.read_csv(csv_path)[['question_id', 'question_category', 'question']]
+
+def make_synthetic_questions(seed_df, n_rows):
+    """Replicate the seed questions up to n_rows, giving every copy a unique question_id"""
+    repeats = -(-n_rows // len(seed_df))
+    df = pd.concat([seed_df] * repeats, ignore_index=True).head(n_rows)
+    df['question_id'] = df['question_id'].astype(str) + "-" + (df.index // len(seed_df)).astype(str)
+    return df
+
+def current_rss_mb():
+    """Current (not peak) resident set size of this process in MB"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+def file_mb(path):
+    return os.path.getsize(path) / (1024 * 1024) if os.path.exists(path) else 0.0
+
+def _run_config(config, csv_path, workdir, result_queue):
+    """Child process: run one configuration end to end and report its measurements"""
+    import resource
+
+    # Silence per-question progress output (including from spawned workers) so it doesn't skew timings
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    rss_before = current_rss_mb()
+
+    start = time.perf_counter()
+    questions_df = bench.load_benchmark_data(csv_path)
+    load_s = time.perf_counter() - start
+
+    output_file = os.path.join(workdir, f"results_{config['rows']}_{config['batch_size']}_{config['workers']}.csv")
+    backend = MockBackend(token_latency=config['token_latency'], prefill_latency=config['prefill_latency'])
+
+    start = time.perf_counter()
+    if config['workers'] > 1:
+        bench.run_benchmark_parallel(questions_df, output_file, num_workers=config['workers'], threads_per_worker=1,
+                                     shard_size=config['shard_size'], batch_size=config['batch_size'],
+                                     backend=backend)
+    else:
+        bench.run_benchmark(None, None, questions_df, output_file, batch_size=config['batch_size'], backend=backend)
+    run_s = time.perf_counter() - start
+
+    # I/O cost of rebuilding the final results file from the stream on its own
+    stream_path = bench.results_stream_path(output_file)
+    start = time.perf_counter()
+    bench.write_results_file(stream_path, output_file, questions_df['question_id'].tolist())
+    write_s = time.perf_counter() - start
+
+    rss_after = current_rss_mb()
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+    result_queue.put({
+        **config,
+        'load_s': load_s,
+        'run_s': run_s,
+        'rows_per_s': config['rows'] / run_s,
+        'write_s': write_s,
+        'rss_before_mb': rss_before,
+        'rss_after_mb': rss_after,
+        'rss_growth_mb': rss_after - rss_before,
+        'peak_rss_mb': peak,
+        'stream_mb': file_mb(stream_path),
+        'output_mb': file_mb(output_file),
+    })
+
+def run_suite(seed_df, sizes, batch_sizes, worker_counts, token_latency=0.0, prefill_latency=0.0, shard_size=256):
+    """Run every (size, batch size, workers) combination, each in a fresh process"""
+    ctx = mp.get_context("spawn")
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="gemma3_suite_") as workdir:
+        for rows in sizes:
+            csv_path = os.path.join(workdir, f"questions_{rows}.csv")
+            make_synthetic_questions(seed_df, rows).to_csv(csv_path, index=False)
+            print(f"📋 {rows} synthetic questions ({file_mb(csv_path):.1f} MB CSV)")
+
+            for batch_size in batch_sizes:
+                for workers in worker_counts:
+                    config = {
+                        'rows': rows,
+                        'batch_size': batch_size,
+                        'workers': workers,
+                        'shard_size': shard_size,
+                        'token_latency': token_latency,
+                        'prefill_latency': prefill_latency,
+                    }
+                    print(f"🔄 rows={rows} batch_size={batch_size} workers={workers}...", end=" ", flush=True)
+
+                    result_queue = ctx.Queue()
+                    child = ctx.Process(target=_run_config, args=(config, csv_path, workdir, result_queue))
+                    child.start()
+                    result = result_queue.get()
+                    child.join()
+
+                    print(f"{result['rows_per_s']:.0f} rows/sec")
+                    results.append(result)
+
+    return pd.DataFrame(results)
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Offline pipeline throughput/scaling benchmark (no model needed)")
+    parser.add_argument("--csv", default=bench.DEFAULT_CSV_PATH, help="Seed questions to replicate")
+    parser.add_argument("--sizes", default="10000,100000", help="Comma-separated dataset sizes")
+    parser.add_argument("--batch-sizes", default="1,32", help="Comma-separated batch sizes")
+    parser.add_argument("--workers", default="1,4", help="Comma-separated worker counts")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Mock seconds per decode step")
+    parser.add_argument("--prefill-latency", type=float, default=0.0, help="Mock seconds per prompt token")
+    parser.add_argument("--shard-size", type=int, default=256, help="Questions per worker shard")
+    parser.add_argument("--output", default="benchmark_suite_results.csv", help="Where to write the measurements")
+    args = parser.parse_args()
+
+    print("🚀 Gemma-3 Benchmark Pipeline Scaling Suite (mock backend)")
+    print("=" * 50)
+
+    seed_df = load_seed_questions(args.csv)
+    print(f"✓ Loaded {len(seed_df)} seed questions")
+
+    results_df = run_suite(
+        seed_df,
+        sizes=[int(x) for x in args.sizes.split(",")],
+        batch_sizes=[int(x) for x in args.batch_sizes.split(",")],
+        worker_counts=[int(x) for x in args.workers.split(",")],
+        token_latency=args.token_latency,
+        prefill_latency=args.prefill_latency,
+        shard_size=args.shard_size,
+    )
+
+    results_df.to_csv(args.output, index=False)
+
+    print("=" * 50)
+    columns = ['rows', 'batch_size', 'workers', 'load_s', 'run_s', 'rows_per_s', 'write_s',
+               'rss_growth_mb', 'peak_rss_mb', 'stream_mb', 'output_mb']
+    print(results_df[columns].round(2).to_string(index=False))
+    print(f"\n📁 Measurements saved to {args.output}")
+
+if __name__ == "__main__":
+    sys.exit(main())
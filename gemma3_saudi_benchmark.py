@@ -3,29 +3,78 @@
 Simple script to run Gemma-3 model on Pico-Saudi-LLMs-Benchmark dataset using Unsloth
 """
 
-import pandas as pd
-import torch
 from datetime import datetime
+import argparse
+import contextlib
+import copy
+import hashlib
+import json
 import os
+import random
+import sqlite3
 import sys
+import time
 
-def check_requirements():
-    """Check if required packages are installed"""
-    try:
-        import unsloth
-        from transformers import AutoTokenizer, AutoModelForCausalLM
+from benchmark_data import load_questions
+
+# torch, transformers and pandas are imported inside the functions that use them, so
+# --help, the mock backend and worker start-up don't pay for them
+STARTUP_TIME = time.perf_counter()
+
+MODEL_NAME = "unsloth/gemma-3-270m-it-GGUF"
+DEFAULT_CSV_PATH = "Pico-Saudi-LLMs-Benchmark/v0.01/Pico-Saudi-LLMs-Questions-v0.01.csv"
+SYSTEM_PROMPT = "You must provide all your responses exclusively in Arabic"
+FALLBACK_MODEL_NAME = "google/gemma-2-270m-it"
+# Plain (non-GGUF) checkpoint of the same model, loaded by the CPU backend
+CPU_MODEL_NAME = "google/gemma-3-270m-it"
+
+# Which loader worked last time (see setup_gemma3_model)
+LOADER_MANIFEST = ".gemma3_loader.json"
+
+# Per-question performance columns added to every result row
+METRIC_COLUMNS = [
+    'prompt_tokens',
+    'generated_tokens',
+    'prefill_s',
+    'ttft_s',
+    'decode_tokens_per_s',
+    'total_s',
+    'peak_rss_mb',
+    'acceptance_rate',  # Share of prompt-lookup draft tokens the model kept
+]
+
+# Gemma 3 recommended generation settings
+GENERATION_KWARGS = {
+    "max_new_tokens": 256,
+    "do_sample": True,
+    "temperature": 1.0,
+    "top_k": 64,
+    "top_p": 0.95,
+    "repetition_penalty": 1.0,
+}
+
+# A Gemma turn ends with <end_of_turn>; generation also stops at EOS and at any STOP_STRINGS
+END_OF_TURN = "<end_of_turn>"
+STOP_STRINGS = []
+
+def check_requirements(packages=("torch", "transformers", "unsloth")):
+    """Check if required packages are installed (without importing them)"""
+    from importlib.util import find_spec
+    missing = [name for name in packages if find_spec(name) is None]
+    if not missing:
         print("✓ All required packages are available")
         return True
-    except ImportError as e:
-        print(f"❌ Missing package: {e}")
-        print("Please install required packages:")
-        print("pip install unsloth transformers torch pandas")
-        return False
-
-def load_benchmark_data(csv_path):
-    """Load the benchmark questions from CSV file"""
+    print(f"❌ Missing package: {', '.join(missing)}")
+    print("Please install required packages:")
+    print("pip install unsloth transformers torch pandas")
+    return False
+
+def load_benchmark_data(csv_path, categories=None, question_ids=None):
+    """Load the benchmark questions from CSV file, optionally only some categories or question_ids"""
     try:
-        df = pd.read_csv(csv_path)
+        if not os.path.exists(csv_path):
+            raise FileNotFoundError(csv_path)
+        df = load_questions(csv_path, categories, question_ids)
         print(f"✓ Loaded {len(df)} questions from benchmark dataset")
         return df
     except FileNotFoundError:
@@ -35,184 +84,2017 @@ def load_benchmark_data(csv_path):
         print(f"❌ Error loading benchmark data: {e}")
         return None
 
-def setup_gemma3_model():
-    """Setup Gemma-3 270M GGUF model using Unsloth"""
+def _load_unsloth(load_in_4bit, local_files_only=False, model_name=MODEL_NAME):
+    from unsloth import FastLanguageModel
+    
+    model, tokenizer = FastLanguageModel.from_pretrained(
+        model_name=model_name,  # Exact GGUF model specified
+        max_seq_length=2048,
+        dtype=None,  # Auto detection
+        load_in_4bit=load_in_4bit,  # GGUF models work well with quantization
+        local_files_only=local_files_only,
+    )
+    
+    # Enable inference mode
+    FastLanguageModel.for_inference(model)
+    return model, tokenizer
+
+def _load_transformers(local_files_only=False, model_name=FALLBACK_MODEL_NAME):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    
+    tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=local_files_only)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.float16,
+        device_map="auto",
+        local_files_only=local_files_only,
+    )
+    return model, tokenizer
+
+def model_loaders(model_name=MODEL_NAME):
+    """Loaders tried in order for a model: (name, description, load function)
+    
+    The GGUF checkpoint can't be loaded by plain transformers, so for it the last resort is
+    FALLBACK_MODEL_NAME; any other model is loaded as is.
+    """
+    fallback = FALLBACK_MODEL_NAME if model_name == MODEL_NAME else model_name
+    return [
+        ("unsloth_4bit", f"{model_name} with Unsloth (4-bit)", lambda local: _load_unsloth(True, local, model_name)),
+        ("unsloth", f"{model_name} with Unsloth (no quantization)",
+         lambda local: _load_unsloth(False, local, model_name)),
+        ("transformers", f"{'fallback ' if fallback != model_name else ''}{fallback} with transformers",
+         lambda local: _load_transformers(local, fallback)),
+    ]
+
+def read_loader_manifest(path=LOADER_MANIFEST, model_name=MODEL_NAME):
+    """The loader that worked last time, or None"""
     try:
-        from unsloth import FastLanguageModel
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # A manifest written for another model says nothing about this one
+    if manifest.get('model_name') != model_name:
+        return None
+    return manifest
+
+def write_loader_manifest(loader, model, path=LOADER_MANIFEST, model_name=MODEL_NAME):
+    """Remember which loader worked so the next start goes straight to it"""
+    manifest = {
+        'model_name': model_name,
+        'loader': loader,
+        'dtype': str(getattr(model, "dtype", None)),
+        'device': str(getattr(model, "device", None)),
+        'saved_at': datetime.now().isoformat(),
+    }
+    try:
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠️  Could not save loader manifest {path}: {e}")
+
+def setup_gemma3_model(manifest_path=LOADER_MANIFEST, model_name=MODEL_NAME, loader=None):
+    """Setup Gemma-3 270M GGUF model using Unsloth
+    
+    The loader that succeeds is recorded in manifest_path. Later runs try it first from
+    the local model cache, and only go through the whole fallback chain if that fails.
+    model_name loads another checkpoint through the same chain; loader restricts the
+    chain to one of its entries (e.g. "unsloth_4bit").
+    """
+    start = time.perf_counter()
+    chain = [entry for entry in model_loaders(model_name) if loader is None or entry[0] == loader]
+    loaders = {name: (description, load) for name, description, load in chain}
+    
+    manifest = read_loader_manifest(manifest_path, model_name) if manifest_path else None
+    if manifest is not None and manifest.get('loader') in loaders:
+        name = manifest['loader']
+        description, load = loaders[name]
+        print(f"🔄 Loading {description} (from {manifest_path})...")
+        try:
+            model, tokenizer = load(True)
+            print(f"✓ Model loaded in {time.perf_counter() - start:.1f}s")
+            return model, tokenizer
+        except Exception as e:
+            print(f"❌ Saved loader '{name}' failed: {e}")
+            print("Trying every loading method...")
+    
+    for name, description, load in chain:
+        print(f"🔄 Loading {description}...")
+        try:
+            model, tokenizer = load(False)
+        except Exception as e:
+            print(f"❌ Error loading {description}: {e}")
+            continue
+        
+        print(f"✓ Model loaded in {time.perf_counter() - start:.1f}s")
+        if manifest_path:
+            write_loader_manifest(name, model, manifest_path, model_name)
+        return model, tokenizer
+    
+    return None, None
+
+def set_cpu_threads(threads=None, interop_threads=None):
+    """Pin torch's intra-op and inter-op thread pools"""
+    import torch
+    
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:  # Only allowed before any inter-op parallel work has started
+            print(f"⚠️  Could not set inter-op threads: {e}")
+    print(f"✓ Torch threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+def quantize_linear_int8(model):
+    """Replace every Linear layer with a dynamically quantized int8 one (weights int8, activations quantized per call)"""
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+    
+    return quantize_dynamic(model.float(), {torch.nn.Linear}, dtype=torch.qint8)
+
+def enable_static_cache_decoding(model, max_cache_len=None):
+    """Make generate use a fixed-size KV cache and a torch.compile'd decode step (see decode_cache_kwargs)"""
+    from transformers import CompileConfig
+    
+    # dynamic=None: the sliding-window layers' fill level is a Python int that changes every step, so
+    # it is compiled static once and then made dynamic instead of recompiled until dynamo gives up
+    compile_config = CompileConfig(fullgraph=False, dynamic=None, mode="default")
+    # generate only auto-compiles on accelerators unless told otherwise
+    compile_config._compile_all_devices = True
+    model.generation_config.compile_config = compile_config
+    # One cache size for every prompt length, so the compiled step is reused instead of recompiled
+    model.static_cache_len = max_cache_len or 1024 + GENERATION_KWARGS['max_new_tokens']
+
+def decode_cache_kwargs(model, extra):
+    """generate kwargs selecting the static cache, unless this call brings its own KV cache"""
+    if getattr(model, "static_cache_len", None) and "past_key_values" not in extra:
+        return {"cache_implementation": "static", "max_cache_len": model.static_cache_len}
+    return {}
+
+def warm_up(model, tokenizer, batch_sizes=(1,)):
+    """Run each batch size once so compilation happens before the first timed question"""
+    start = time.perf_counter()
+    for batch_size in batch_sizes:
+        generate_batch_responses(model, tokenizer, ["مرحبا"] * batch_size)
+    print(f"✓ Warmed up batch sizes {list(batch_sizes)} in {time.perf_counter() - start:.1f}s")
+
+def setup_cpu_model(dtype="float32", int8=False, compile=False, threads=None, interop_threads=None,
+                    warmup_batch_sizes=(1,), model_name=CPU_MODEL_NAME):
+    """Load the model for CPU-only inference
+    
+    Weights are loaded in float32 or bfloat16 (float16 is slow or unsupported on most CPUs),
+    optionally with int8 dynamic quantization of the Linear layers and a compiled static-cache
+    decode step, which is warmed up here once per process. Quantized layers take float32
+    activations, so int8 always runs the rest of the model in float32.
+    """
+    try:
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
         
-        print("🔄 Loading Gemma-3 270M GGUF model using Unsloth...")
+        set_cpu_threads(threads, interop_threads)
         
-        # Load GGUF model with Unsloth optimizations
-        model, tokenizer = FastLanguageModel.from_pretrained(
-            model_name="unsloth/gemma-3-270m-it-GGUF",  # Exact GGUF model specified
-            max_seq_length=2048,
-            dtype=None,  # Auto detection
-            load_in_4bit=True,  # GGUF models work well with quantization
-        )
+        options = [dtype] + (["int8 dynamic"] if int8 else []) + (["compiled static cache"] if compile else [])
+        print(f"🔄 Loading {model_name} for CPU ({', '.join(options)})...")
+        start = time.perf_counter()
         
-        # Enable inference mode
-        FastLanguageModel.for_inference(model)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=getattr(torch, dtype),
+                                                     low_cpu_mem_usage=True).eval()
+        if int8:
+            model = quantize_linear_int8(model)
+        if compile:
+            enable_static_cache_decoding(model)
+        # Part of the model identity, so cached responses aren't shared across CPU configurations
+        model.cpu_backend = {'dtype': dtype, 'int8': bool(int8), 'compile': bool(compile)}
         
-        print("✓ Gemma-3 270M GGUF model loaded successfully")
+        print(f"✓ CPU model loaded in {time.perf_counter() - start:.1f}s")
+        if compile:
+            warm_up(model, tokenizer, warmup_batch_sizes)
         return model, tokenizer
         
     except Exception as e:
-        print(f"❌ Error loading GGUF model with Unsloth: {e}")
-        print("Trying alternative loading method...")
-        
-        try:
-            from unsloth import FastLanguageModel
-            
-            # Try without quantization
-            print("🔄 Trying without quantization...")
-            model, tokenizer = FastLanguageModel.from_pretrained(
-                model_name="unsloth/gemma-3-270m-it-GGUF",
-                max_seq_length=2048,
-                dtype=None,
-                load_in_4bit=False,
-            )
-            
-            FastLanguageModel.for_inference(model)
-            print("✓ GGUF model loaded without quantization")
-            return model, tokenizer
-            
-        except Exception as e2:
-            print(f"❌ Error with alternative method: {e2}")
-            print("Falling back to standard transformers...")
-            
-            try:
-                from transformers import AutoModelForCausalLM, AutoTokenizer
-                
-                # Fallback to regular Gemma 2 270M
-                model_name = "google/gemma-2-270m-it"
-                print(f"🔄 Loading fallback {model_name} with transformers...")
-                tokenizer = AutoTokenizer.from_pretrained(model_name)
-                model = AutoModelForCausalLM.from_pretrained(
-                    model_name,
-                    torch_dtype=torch.float16,
-                    device_map="auto"
-                )
-                
-                print("✓ Fallback model loaded successfully")
-                return model, tokenizer
-                
-            except Exception as e3:
-                print(f"❌ Error loading fallback model: {e3}")
-                return None, None
-
-def generate_response(model, tokenizer, question, max_length=512):
-    """Generate response for a single question"""
+        print(f"❌ Error loading CPU model: {e}")
+        return None, None
+
+def measure_decode_speed(model, tokenizer, questions):
+    """Answer the questions one at a time; returns (generated tokens per second, seconds)"""
+    tokens = seconds = 0
+    for question in questions:
+        _, metrics = generate_response(model, tokenizer, question, return_metrics=True)
+        tokens += metrics['generated_tokens'] or 0
+        seconds += metrics['total_s'] or 0
+    return (tokens / seconds if seconds else 0.0), seconds
+
+def report_cpu_speedup(model, tokenizer, questions, model_name=CPU_MODEL_NAME):
+    """Time the questions on the CPU backend and on the current path (float16 weights, dynamic cache)"""
+    import torch
+    from transformers import AutoModelForCausalLM
+    
+    print(f"⏱️  Timing {len(questions)} questions on the current path and the CPU backend...")
     try:
-        # Format the prompt according to Gemma's chat template
-        prompt = f"""<bos><start_of_turn>user
-{question}<end_of_turn>
+        baseline = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float16).eval()
+        baseline_speed, baseline_s = measure_decode_speed(baseline, tokenizer, questions)
+        del baseline
+    except Exception as e:
+        print(f"⚠️  Current path failed, no speedup to report: {e}")
+        return None
+    
+    cpu_speed, cpu_s = measure_decode_speed(model, tokenizer, questions)
+    speedup = cpu_speed / baseline_speed if baseline_speed else float("inf")
+    print(f"   Current path (float16): {baseline_speed:.1f} tokens/s ({baseline_s:.1f}s)")
+    print(f"   CPU backend:            {cpu_speed:.1f} tokens/s ({cpu_s:.1f}s)")
+    print(f"📈 CPU backend speedup: {speedup:.2f}x")
+    return speedup
+
+def prompt_prefix(system_prompt=None):
+    """The part of the chat template shared by every question"""
+    # Gemma has no system role, so the instruction opens the user turn
+    prefix = "<bos><start_of_turn>user\n"
+    if system_prompt:
+        prefix += f"{system_prompt}\n\n"
+    return prefix
+
+def build_prompt(question, system_prompt=None):
+    """Format a question according to Gemma's chat template"""
+    return f"""{prompt_prefix(system_prompt)}{question}<end_of_turn>
 <start_of_turn>model
 """
+
+def repeat_past(past, batch_size):
+    """Repeat a batch-of-one KV cache batch_size times (in place for Cache objects)"""
+    if batch_size == 1:
+        return past
+    if isinstance(past, tuple):
+        return tuple(tuple(t.repeat_interleave(batch_size, dim=0) for t in layer) for layer in past)
+    past.batch_repeat_interleave(batch_size)
+    return past
+
+def past_length(past):
+    """Number of tokens held in a KV cache"""
+    if past is None:
+        return 0
+    if isinstance(past, tuple):
+        return past[0][0].shape[2]
+    return past.get_seq_length()
+
+class PrefixCache:
+    """Past key/values of the shared template prefix, computed once per model load"""
+    
+    def __init__(self, model, tokenizer, system_prompt=None, max_length=1024):
+        self.system_prompt = system_prompt
+        self.max_length = max_length
+        self.prefix = prompt_prefix(system_prompt)
+        self.prefix_ids = tokenizer(self.prefix)["input_ids"]
+        config = model.config.get_text_config() if hasattr(model.config, "get_text_config") else model.config
+        self.sliding_window = getattr(config, "sliding_window", None)
         
-        # Tokenize input
-        inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=1024)
+        import torch
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        with torch.no_grad():
+            outputs = model(input_ids=torch.tensor([self.prefix_ids], device=device), use_cache=True)
+        self.past_key_values = outputs.past_key_values
         
-        # Move to GPU if available
-        if torch.cuda.is_available():
-            inputs = {k: v.to("cuda") for k, v in inputs.items()}
+        print(f"✓ Cached {len(self.prefix_ids)} shared prefix tokens")
+    
+    def expand(self, batch_size):
+        """Fresh copy of the prefix cache for a batch (generate extends it in place)"""
+        return repeat_past(copy.deepcopy(self.past_key_values), batch_size)
+    
+    def prepare(self, tokenizer, questions, token_ids=None):
+        """Build inputs of shape [prefix][padding][question] that reuse the cached prefix
+        
+        Returns None when the batch has to be run without the cache (see below).
+        """
+        import torch
+        
+        n = len(self.prefix_ids)
+        suffixes = []
+        for i, q in enumerate(questions):
+            if token_ids is not None and list(token_ids[i][:n]) == self.prefix_ids:
+                # Pre-tokenized prompt: drop the prefix tokens that are already cached
+                suffixes.append(list(token_ids[i][n:]))
+            else:
+                suffixes.append(tokenizer(build_prompt(q, self.system_prompt)[len(self.prefix):],
+                                          add_special_tokens=False)["input_ids"][:self.max_length - n])
+        
+        # Padding sits between the prefix and the question so the cached prefix lines up in every row
+        width = max(len(ids) for ids in suffixes)
+        # Masked padding still takes up positions inside a sliding window, so a padded row would see
+        # fewer real tokens than it does uncached once the sequence outgrows the window
+        padded = min(len(ids) for ids in suffixes) < width
+        if padded and self.sliding_window and n + width + GENERATION_KWARGS['max_new_tokens'] > self.sliding_window:
+            return None
+        pad = [tokenizer.pad_token_id]
+        input_ids = [self.prefix_ids + pad * (width - len(ids)) + ids for ids in suffixes]
+        attention_mask = [[1] * len(self.prefix_ids) + [0] * (width - len(ids)) + [1] * len(ids) for ids in suffixes]
+        
+        inputs = {"input_ids": torch.tensor(input_ids), "attention_mask": torch.tensor(attention_mask)}
+        return inputs, {"past_key_values": self.expand(len(questions))}
+
+def prepare_inputs(tokenizer, questions, system_prompt=None, prefix_cache=None, token_ids=None):
+    """Tokenize a list of questions into left-padded model inputs plus any extra generate kwargs
+    
+    token_ids, if given, holds the already tokenized prompt of every question (see prompt_store.py).
+    """
+    import torch
+    
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    
+    prepared = prefix_cache.prepare(tokenizer, questions, token_ids) if prefix_cache is not None else None
+    if prepared is not None:
+        inputs, extra = prepared
+    elif token_ids is not None:
+        # Decoder-only models must be left-padded so every prompt ends at the same column
+        width = max(len(ids) for ids in token_ids)
+        inputs = {
+            "input_ids": torch.tensor([[tokenizer.pad_token_id] * (width - len(ids)) + list(ids) for ids in token_ids]),
+            "attention_mask": torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in token_ids]),
+        }
+        extra = {}
+    else:
+        prompts = [build_prompt(q, system_prompt) for q in questions]
+        
+        # Decoder-only models must be left-padded so every prompt ends at the same column
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True, truncation=True, max_length=1024)
+        finally:
+            tokenizer.padding_side = padding_side
+        extra = {}
+    
+    # Move to GPU if available
+    if torch.cuda.is_available():
+        inputs = {k: v.to("cuda") for k, v in inputs.items()}
+    
+    return inputs, extra
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return None
+    # ru_maxrss is reported in KB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+class GenerationTimer:
+    """Times one generate call: prefill, first token and total wall time"""
+    
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.prefill_done = None
+        self.first_token = None
+    
+    def generate_kwargs(self):
+        """Hooks that generate calls after the prefill forward pass and after each sampled token"""
+        import torch
+        from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+        timer = self
+        
+        class PrefillTimer(LogitsProcessor):
+            def __call__(self, input_ids, scores):
+                if timer.prefill_done is None:
+                    timer.prefill_done = time.perf_counter()
+                return scores
+        
+        class FirstTokenTimer(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                if timer.first_token is None:
+                    timer.first_token = time.perf_counter()
+                return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        
+        return {
+            "logits_processor": LogitsProcessorList([PrefillTimer()]),
+            "stopping_criteria": StoppingCriteriaList([FirstTokenTimer()]),
+        }
+    
+    def metrics(self, attention_mask, new_tokens, tokenizer):
+        """Per-row metrics for a finished generate call"""
+        end = time.perf_counter()
+        rss = peak_rss_mb()
+        prompt_tokens = attention_mask.sum(dim=1).tolist()
+        
+        rows = []
+        for prompt_count, generated in zip(prompt_tokens, count_generated_tokens(new_tokens, tokenizer)):
+            decode_time = end - self.first_token if self.first_token is not None else 0.0
+            rows.append({
+                'prompt_tokens': prompt_count,
+                'generated_tokens': generated,
+                'prefill_s': (self.prefill_done or end) - self.start,
+                'ttft_s': (self.first_token or end) - self.start,
+                'decode_tokens_per_s': (generated - 1) / decode_time if generated > 1 and decode_time > 0 else None,
+                'total_s': end - self.start,
+                'peak_rss_mb': rss,
+            })
+        return rows
+
+def stop_token_ids(tokenizer):
+    """Token ids that end a response: EOS and <end_of_turn>"""
+    ids = [tokenizer.eos_token_id]
+    end_of_turn = tokenizer.convert_tokens_to_ids(END_OF_TURN)
+    if end_of_turn is not None and end_of_turn != tokenizer.unk_token_id:
+        ids.append(end_of_turn)
+    return [token for token in dict.fromkeys(ids) if token is not None]
+
+def stop_string_criteria(tokenizer, prompt_length):
+    """Stopping criterion that finishes each row once its generated text contains a stop string"""
+    import torch
+    from transformers import StoppingCriteria
+    
+    class StopStrings(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            texts = tokenizer.batch_decode(input_ids[:, prompt_length:], skip_special_tokens=True)
+            return torch.tensor([any(stop in text for stop in STOP_STRINGS) for text in texts],
+                                dtype=torch.bool, device=input_ids.device)
+    
+    return StopStrings()
+
+def stop_kwargs(tokenizer, prompt_length, stopping_criteria=None):
+    """generate kwargs that finish each sequence of a batch at its own stop token or stop string"""
+    kwargs = {"eos_token_id": stop_token_ids(tokenizer)}
+    if STOP_STRINGS:
+        from transformers import StoppingCriteriaList
+        criteria = StoppingCriteriaList(stopping_criteria or [])
+        criteria.append(stop_string_criteria(tokenizer, prompt_length))
+        kwargs["stopping_criteria"] = criteria
+    return kwargs
+
+def generation_settings():
+    """Everything besides the prompt that shapes a response (part of every cache key)"""
+    return {**GENERATION_KWARGS, 'stop_tokens': [END_OF_TURN], 'stop_strings': list(STOP_STRINGS)}
+
+@contextlib.contextmanager
+def generation_overrides(**overrides):
+    """Temporarily change GENERATION_KWARGS, e.g. generation_overrides(do_sample=False, max_new_tokens=64)"""
+    unknown = set(overrides) - set(GENERATION_KWARGS)
+    if unknown:
+        raise ValueError(f"Unknown generation settings: {', '.join(sorted(unknown))}")
+    
+    saved = dict(GENERATION_KWARGS)
+    GENERATION_KWARGS.update(overrides)
+    try:
+        yield GENERATION_KWARGS
+    finally:
+        GENERATION_KWARGS.clear()
+        GENERATION_KWARGS.update(saved)
+
+def truncate_at_stop(text):
+    """Cut a response at the first configured stop string (generate keeps the stop string itself)"""
+    positions = [text.find(stop) for stop in STOP_STRINGS if stop in text]
+    return text[:min(positions)] if positions else text
+
+def decode_new_tokens(tokenizer, new_tokens):
+    """Decode only the generated part of each row"""
+    return [truncate_at_stop(text).strip() for text in tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+def count_generated_tokens(new_tokens, tokenizer):
+    """Number of generated tokens per row, up to and including the first stop token"""
+    stops = set(stop_token_ids(tokenizer))
+    counts = []
+    for row in new_tokens.tolist():
+        count = 0
+        for token in row:
+            if token == tokenizer.pad_token_id and token not in stops:
+                break
+            count += 1
+            if token in stops:
+                break
+        counts.append(count)
+    return counts
+
+def generate_response(model, tokenizer, question, max_length=512, system_prompt=None, prefix_cache=None,
+                      return_metrics=False, token_ids=None, prompt_lookup=None):
+    """Generate response for a single question
+    
+    prompt_lookup ({'ngram_size', 'num_tokens'}) switches to generate_with_prompt_lookup.
+    """
+    import torch
+    
+    timer = GenerationTimer()
+    try:
+        if prompt_lookup is not None:
+            response, metrics = generate_with_prompt_lookup(model, tokenizer, question, system_prompt, prefix_cache,
+                                                            token_ids, **prompt_lookup)
+            return (response, metrics) if return_metrics else response
+        
+        # Tokenize input
+        inputs, extra = prepare_inputs(tokenizer, [question], system_prompt, prefix_cache,
+                                       [token_ids] if token_ids is not None else None)
+        if return_metrics:
+            extra.update(timer.generate_kwargs())
+        extra.update(stop_kwargs(tokenizer, inputs["input_ids"].shape[1], extra.get("stopping_criteria")))
+        extra.update(decode_cache_kwargs(model, extra))
         
         # Generate response with Gemma 3 recommended settings
         with torch.no_grad():
             outputs = model.generate(
                 **inputs,
-                max_new_tokens=256,
-                do_sample=True,
-                temperature=1.0,     # Recommended for Gemma 3
-                top_k=64,           # Recommended for Gemma 3
-                top_p=0.95,         # Recommended for Gemma 3
-                repetition_penalty=1.0,  # Recommended for Gemma 3
+                **extra,
+                **GENERATION_KWARGS,
                 pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.eos_token_id,
             )
         
-        # Decode response
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        # Extract only the model's response (after the last model turn)
-        if "<start_of_turn>model" in response:
-            response = response.split("<start_of_turn>model")[-1].strip()
+        # Decode only the model's response, not the prompt
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        response = decode_new_tokens(tokenizer, new_tokens)[0]
         
+        if return_metrics:
+            return response, timer.metrics(inputs["attention_mask"], new_tokens, tokenizer)[0]
         return response
         
     except Exception as e:
+        if is_out_of_memory(e):  # Left to the caller, which can retry with less
+            raise
         print(f"❌ Error generating response: {e}")
-        return f"Error: {str(e)}"
+        return (f"Error: {str(e)}", {}) if return_metrics else f"Error: {str(e)}"
+
+def stream_response(model, tokenizer, question, system_prompt=None, prefix_cache=None):
+    """Yield the response to a single question piece by piece while it is being generated"""
+    import threading
+    import torch
+    from transformers import TextIteratorStreamer
+    
+    inputs, extra = prepare_inputs(tokenizer, [question], system_prompt, prefix_cache)
+    extra.update(stop_kwargs(tokenizer, inputs["input_ids"].shape[1]))
+    extra.update(decode_cache_kwargs(model, extra))
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+    
+    def run():
+        try:
+            with torch.no_grad():
+                model.generate(**inputs, **extra, **GENERATION_KWARGS, pad_token_id=tokenizer.eos_token_id,
+                               streamer=streamer)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    
+    # Hold back the last few characters in case they turn out to start a stop string
+    hold = max((len(stop) for stop in STOP_STRINGS), default=1) - 1
+    pending = ""
+    started = False
+    for text in streamer:
+        pending += text
+        if not started:
+            pending = pending.lstrip()
+            started = bool(pending)
+        cut = truncate_at_stop(pending)
+        if len(cut) < len(pending):
+            pending = cut
+            break
+        if len(pending) > hold:
+            yield pending[:len(pending) - hold]
+            pending = pending[len(pending) - hold:]
+    if pending.rstrip():
+        yield pending.rstrip()
+    
+    thread.join()
+    if errors:
+        print(f"❌ Error generating response: {errors[0]}")
+        yield f"Error: {str(errors[0])}"
+
+class NgramLookup:
+    """Index of the n-grams in a token sequence, used to propose how its tail continues"""
+    
+    def __init__(self, tokens, ngram_size=3):
+        self.ngram_size = ngram_size
+        self.tokens = []
+        self.latest = {}  # n-gram -> position right after its latest occurrence
+        self.extend(tokens)
+    
+    def extend(self, tokens):
+        for token in tokens:
+            # Every n-gram ending here is now followed by token
+            end = len(self.tokens)
+            for n in range(1, min(self.ngram_size, end) + 1):
+                self.latest[tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(token)
+    
+    def propose(self, count):
+        """Up to count tokens that followed the longest earlier match of the current tail"""
+        if count <= 0:
+            return []
+        for n in range(min(self.ngram_size, len(self.tokens)), 0, -1):
+            start = self.latest.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start:start + count]
+        return []
+
+def crop_past(past, tokens):
+    """Drop the last tokens positions from a KV cache (also trims sliding window layers back to size)"""
+    if hasattr(past, "activate_past_recording"):
+        past.crop(-tokens)
+    elif tokens:
+        past.crop(past.get_seq_length() - tokens)
+
+def generate_with_prompt_lookup(model, tokenizer, question, system_prompt=None, prefix_cache=None, token_ids=None,
+                                ngram_size=3, num_tokens=10):
+    """Generate a response for one question with prompt-lookup speculative decoding
+    
+    Draft tokens are copied from what followed the latest earlier occurrence of the last
+    ngram_size tokens (in the prompt or the answer so far). One forward pass checks up to
+    num_tokens of them; the model keeps the ones it agrees with plus its own next token, so
+    greedy output is exactly that of plain decoding. Returns (response, metrics).
+    """
+    import torch
+    
+    start = time.perf_counter()
+    inputs, extra = prepare_inputs(tokenizer, [question], system_prompt, prefix_cache,
+                                   [token_ids] if token_ids is not None else None)
+    input_ids = inputs["input_ids"]
+    past = extra.get("past_key_values")
+    
+    with torch.no_grad():
+        outputs = model(input_ids=input_ids[:, past_length(past):], attention_mask=inputs["attention_mask"],
+                        past_key_values=past, use_cache=True)
+    past = outputs.past_key_values
+    if hasattr(past, "activate_past_recording"):
+        # Sliding window layers must keep rejected drafts around until they are cropped
+        past.activate_past_recording()
+    first_token = time.perf_counter()
+    
+    stops = set(stop_token_ids(tokenizer))
+    max_new_tokens = GENERATION_KWARGS['max_new_tokens']
+    generated = [int(pick_next_tokens(outputs.logits[:, -1])[0])]
+    lookup = NgramLookup(input_ids[0].tolist() + generated, ngram_size)
+    proposed = accepted = 0
+    
+    def finished():
+        if generated[-1] in stops or len(generated) >= max_new_tokens:
+            return True
+        text = tokenizer.decode(generated, skip_special_tokens=True) if STOP_STRINGS else ""
+        return any(stop in text for stop in STOP_STRINGS)
+    
+    # The cache always holds everything except the last generated token
+    while not finished():
+        drafts = lookup.propose(min(num_tokens, max_new_tokens - len(generated) - 1))
+        step = torch.tensor([[generated[-1]] + drafts], device=input_ids.device)
+        with torch.no_grad():
+            outputs = model(input_ids=step, past_key_values=past, use_cache=True)
+        past = outputs.past_key_values
+        choices = pick_next_tokens(outputs.logits[0]).tolist()
+        
+        matched = 0
+        while matched < len(drafts) and drafts[matched] == choices[matched]:
+            matched += 1
+        proposed += len(drafts)
+        accepted += matched
+        crop_past(past, len(drafts) - matched)
+        
+        for token in drafts[:matched] + [choices[matched]]:
+            generated.append(token)
+            lookup.extend([token])
+            if finished():
+                break
+    
+    end = time.perf_counter()
+    decode_time = end - first_token
+    response = decode_new_tokens(tokenizer, [generated])[0]
+    return response, {
+        'prompt_tokens': input_ids.shape[1],
+        'generated_tokens': len(generated),
+        'prefill_s': first_token - start,
+        'ttft_s': first_token - start,
+        'decode_tokens_per_s': (len(generated) - 1) / decode_time if len(generated) > 1 and decode_time > 0 else None,
+        'total_s': end - start,
+        'peak_rss_mb': peak_rss_mb(),
+        'acceptance_rate': accepted / proposed if proposed else None,
+    }
+
+def sample_seeds(seed, question_id, samples):
+    """Independent, reproducible seed for every sample of a question"""
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 31)
+    return [int(hashlib.sha256(f"{seed}:{question_id}:{i}".encode()).hexdigest()[:15], 16) for i in range(samples)]
+
+def warp_scores(scores):
+    """Apply the Gemma 3 temperature/top-k/top-p settings to a [batch, vocab] tensor of logits"""
+    import torch
+    
+    scores = scores.float() / GENERATION_KWARGS['temperature']
+    
+    top_k = GENERATION_KWARGS.get('top_k')
+    if top_k:
+        kth = torch.topk(scores, min(top_k, scores.shape[-1])).values[:, -1:]
+        scores = scores.masked_fill(scores < kth, float("-inf"))
+    
+    top_p = GENERATION_KWARGS.get('top_p')
+    if top_p is not None and top_p < 1.0:
+        sorted_scores, sorted_idx = torch.sort(scores, descending=True)
+        probs = sorted_scores.softmax(dim=-1)
+        # Drop tokens once the probability mass before them already exceeds top_p
+        remove = probs.cumsum(dim=-1) - probs > top_p
+        scores = scores.scatter(1, sorted_idx, sorted_scores.masked_fill(remove, float("-inf")))
+    
+    return scores
+
+def pick_next_tokens(logits):
+    """Choose one token per row of [rows, vocab] logits: greedy or sampled per GENERATION_KWARGS"""
+    import torch
+    
+    if not GENERATION_KWARGS['do_sample']:
+        return logits.argmax(dim=-1)
+    return torch.multinomial(warp_scores(logits).softmax(dim=-1), 1).squeeze(1)
+
+def seeded_sampler(seeds):
+    """Logits processor that samples each row with its own seeded generator
+    
+    It applies the Gemma 3 temperature/top-k/top-p settings itself (warp_scores) and leaves only the
+    sampled token finite, so a greedy generate call emits exactly that token.
+    """
+    import torch
+    from transformers import LogitsProcessor
+    
+    class SeededSampler(LogitsProcessor):
+        def __init__(self):
+            self.generators = None
+        
+        def __call__(self, input_ids, scores):
+            if self.generators is None:
+                self.generators = [torch.Generator(device=scores.device).manual_seed(s) for s in seeds]
+            
+            probs = warp_scores(scores).softmax(dim=-1)
+            chosen = torch.cat([torch.multinomial(probs[i], 1, generator=self.generators[i])
+                                for i in range(scores.shape[0])])
+            
+            forced = torch.full_like(scores, float("-inf"))
+            forced[torch.arange(scores.shape[0], device=scores.device), chosen] = 0.0
+            return forced
+    
+    return SeededSampler()
+
+def generate_samples(model, tokenizer, question, seeds, system_prompt=None, prefix_cache=None, token_ids=None):
+    """Draw len(seeds) responses for one question from a single prefill of its prompt"""
+    import torch
+    
+    timer = GenerationTimer()
+    k = len(seeds)
+    try:
+        inputs, extra = prepare_inputs(tokenizer, [question], system_prompt, prefix_cache,
+                                       [token_ids] if token_ids is not None else None)
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+        past = extra.get("past_key_values")
+        
+        # Prefill every prompt token but the last once; generate feeds the last one for each sample
+        cached = past_length(past)
+        if input_ids.shape[1] - 1 > cached:
+            with torch.no_grad():
+                outputs = model(input_ids=input_ids[:, cached:-1], attention_mask=attention_mask[:, :-1],
+                                past_key_values=past, use_cache=True)
+            past = outputs.past_key_values
+        timer.prefill_done = time.perf_counter()
+        
+        hooks = timer.generate_kwargs()
+        sampled = GENERATION_KWARGS['do_sample']
+        if sampled:
+            hooks["logits_processor"].append(seeded_sampler(seeds))
+        hooks.update(stop_kwargs(tokenizer, input_ids.shape[1], hooks["stopping_criteria"]))
+        
+        with torch.no_grad():
+            outputs = model.generate(
+                input_ids=input_ids.repeat(k, 1),
+                attention_mask=attention_mask.repeat(k, 1),
+                past_key_values=repeat_past(past, k),
+                **{**GENERATION_KWARGS, 'do_sample': False, 'temperature': None, 'top_k': None, 'top_p': None},
+                **hooks,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        
+        new_tokens = outputs[:, input_ids.shape[1]:]
+        responses = decode_new_tokens(tokenizer, new_tokens)
+        return responses, timer.metrics(attention_mask.repeat(k, 1), new_tokens, tokenizer)
+        
+    except Exception as e:
+        if is_out_of_memory(e):  # Left to the caller, which can retry with fewer samples at a time
+            raise
+        print(f"❌ Error generating {k} samples: {e}")
+        return [f"Error: {str(e)}"] * k, [{}] * k
+
+class ResponseCache:
+    """On-disk SQLite cache of generated responses with size-based LRU eviction"""
+    
+    def __init__(self, path="gemma3_cache.sqlite", max_size_mb=512, refresh=False):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.refresh = refresh  # Skip lookups but still store fresh responses
+        self.hits = 0
+        self.misses = 0
+        
+        # Parallel workers share the database, so wait for each other's writes
+        self.conn = sqlite3.connect(path, timeout=30)
+        # WAL lets workers keep reading while another one writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    
+    @staticmethod
+    def make_key(model_id, prompt, generation_kwargs, seed=None):
+        """Hash everything that determines a generated response"""
+        payload = json.dumps({
+            'model': model_id,
+            'prompt': prompt,
+            'generation_kwargs': generation_kwargs,
+            'seed': seed,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """Return the cached response for key, or None on a miss (or if the cache is unavailable)"""
+        try:
+            row = None if self.refresh else self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️  Response cache lookup failed ({e}); generating instead")
+            row = None
+        
+        if row is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        try:
+            # Commit straight away: an open write transaction would lock out the other workers
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()  # Only the LRU order is lost
+        return row[0]
+    
+    def put(self, key, response):
+        """Store a response; a busy or broken cache only costs the cache entry"""
+        size = self.size
+        try:
+            self._put(key, response)
+        except sqlite3.Error as e:
+            print(f"⚠️  Could not store response in cache: {e}")
+            self.conn.rollback()
+            self.size = size
+    
+    def _put(self, key, response):
+        """Store a response, evicting the least recently used entries if over budget"""
+        size = len(response.encode('utf-8'))
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                          (key, response, size, time.time()))
+        self.size += size - (old[0] if old else 0)
+        
+        if self.size > self.max_size:
+            evict = []
+            for old_key, old_size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                if self.size <= self.max_size:
+                    break
+                evict.append((old_key,))
+                self.size -= old_size
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", evict)
+        
+        self.conn.commit()
+    
+    def report(self):
+        """Print hit/miss counts for this run"""
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        print(f"🗄️  Cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate) - {self.path}")
+    
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
 
-def run_benchmark(model, tokenizer, questions_df, output_file="gemma3_results.csv"):
-    """Run the model on all benchmark questions"""
+def get_model_identity(model):
+    """Describe the loaded model for cache keys"""
+    config = getattr(model, "config", None)
+    identity = {
+        'name': getattr(config, "_name_or_path", None) or model.__class__.__name__,
+        'class': model.__class__.__name__,
+        'dtype': str(getattr(model, "dtype", None)),
+        'load_in_4bit': bool(getattr(model, "is_loaded_in_4bit", False)),
+    }
+    # Layers swapped for quantized ones after loading (e.g. --int8) don't show in the dtype
+    quantized = sorted({f"{type(m).__module__}.{type(m).__name__}" for m in model.modules()
+                        if ".quantized." in type(m).__module__}) if hasattr(model, "modules") else []
+    if quantized:
+        identity['quantized_layers'] = quantized
+    if getattr(model, "cpu_backend", None) is not None:
+        identity['cpu_backend'] = model.cpu_backend
+    return identity
+
+def prompt_lengths(tokenizer, questions, system_prompt=None):
+    """Tokenized prompt length of each question"""
+    prompts = [build_prompt(q, system_prompt) for q in questions]
+    return [len(ids) for ids in tokenizer(prompts, truncation=True, max_length=1024)["input_ids"]]
+
+def bucket_by_length(lengths, batch_size):
+    """Group question indices into batches of similar prompt length"""
+    # Sorting by length keeps padding (and wasted compute) inside each batch small
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+def generate_batch_responses(model, tokenizer, questions, system_prompt=None, prefix_cache=None,
+                             return_metrics=False, token_ids=None):
+    """Generate responses for a batch of questions with a single generate call"""
+    import torch
+    
+    timer = GenerationTimer()
+    try:
+        inputs, extra = prepare_inputs(tokenizer, questions, system_prompt, prefix_cache, token_ids)
+        if return_metrics:
+            extra.update(timer.generate_kwargs())
+        extra.update(stop_kwargs(tokenizer, inputs["input_ids"].shape[1], extra.get("stopping_criteria")))
+        extra.update(decode_cache_kwargs(model, extra))
+        
+        with torch.no_grad():
+            outputs = model.generate(
+                **inputs,
+                **extra,
+                **GENERATION_KWARGS,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        
+        # Decode only the generated continuation of each prompt
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        responses = decode_new_tokens(tokenizer, new_tokens)
+        
+        if return_metrics:
+            return responses, timer.metrics(inputs["attention_mask"], new_tokens, tokenizer)
+        return responses
+        
+    except Exception as e:
+        if is_out_of_memory(e):  # Left to the caller, which can split the batch
+            raise
+        print(f"❌ Error generating batch of {len(questions)} responses: {e}")
+        errors = [f"Error: {str(e)}"] * len(questions)
+        return (errors, [{}] * len(questions)) if return_metrics else errors
+
+OUT_OF_MEMORY_MESSAGES = ("out of memory", "can't allocate memory", "cannot allocate memory", "not enough memory")
+
+def is_out_of_memory(error):
+    """Whether a generation error means the batch didn't fit in GPU or host memory"""
+    if isinstance(error, MemoryError):
+        return True
+    if 'torch' in sys.modules:
+        import torch
+        if isinstance(error, getattr(torch, 'OutOfMemoryError', torch.cuda.OutOfMemoryError)):
+            return True
+    message = str(error).lower()
+    # CUDA/MPS say "out of memory"; the CPU allocator says "DefaultCPUAllocator: can't allocate memory"
+    return isinstance(error, RuntimeError) and any(text in message for text in OUT_OF_MEMORY_MESSAGES)
+
+def free_memory():
+    """Release what a failed generate call left behind before retrying"""
+    import gc
+    gc.collect()
+    if 'torch' in sys.modules:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def kv_cache_bytes_per_token(model):
+    """KV cache bytes one sequence needs per token: keys and values of every layer"""
+    config = getattr(model.config, "text_config", model.config)
+    heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    return 2 * config.num_hidden_layers * heads * head_dim * model.dtype.itemsize
+
+def read_previous_results(source):
+    """question_category, generated_tokens (and max_new_tokens, if recorded) of an earlier run
+    
+    source is a results file (.csv, .json or .jsonl) or a results store directory.
+    """
+    import pandas as pd
+    
+    columns = ['question_category', 'generated_tokens', 'max_new_tokens']
+    if os.path.isdir(source):
+        from results_store import open_results
+        return open_results(source).to_table(columns=columns).to_pandas()
+    if source.endswith(".jsonl"):
+        df = pd.read_json(source, lines=True)
+    elif source.endswith(".json"):
+        df = pd.read_json(source)
+    else:
+        df = pd.read_csv(source)
+    return df.reindex(columns=columns)
+
+def learn_token_budgets(sources, default=None, quantile=0.95, headroom=1.25, minimum=32, min_samples=5):
+    """Per-category max_new_tokens from the answer lengths of earlier runs
+    
+    A category gets its quantile answer length plus headroom, rounded up to a multiple of 16
+    and capped at default. Categories with too few timed answers, or whose answers often ran
+    into the earlier budget (so their real length is unknown), keep default.
+    """
+    import pandas as pd
+    
+    default = default or GENERATION_KWARGS['max_new_tokens']
+    frames = []
+    for source in sources:
+        try:
+            frames.append(read_previous_results(source))
+        except Exception as e:
+            print(f"⚠️  Could not read previous results {source}: {e}")
+    if not frames:
+        return {}
+    
+    df = pd.concat(frames, ignore_index=True)
+    df['generated_tokens'] = pd.to_numeric(df['generated_tokens'], errors="coerce")
+    df['max_new_tokens'] = pd.to_numeric(df['max_new_tokens'], errors="coerce").fillna(default)
+    df = df[df['generated_tokens'].notna()]
+    
+    budgets = {}
+    for category, group in df.groupby('question_category'):
+        truncated = (group['generated_tokens'] >= group['max_new_tokens']).mean()
+        if len(group) < min_samples or truncated > 1 - quantile:
+            budgets[category] = default
+            continue
+        budget = -(-group['generated_tokens'].quantile(quantile) * headroom // 16) * 16
+        budgets[category] = int(min(default, max(minimum, budget)))
+    
+    print("📋 Token budgets learned from previous runs: "
+          + ", ".join(f"{category}={budget}" for category, budget in sorted(budgets.items())))
+    return budgets
+
+# Largest batch --batch-memory-mb builds when --batch-size isn't given
+MEMORY_BOUND_BATCH_SIZE = 64
+
+class TokenBudgetScheduler:
+    """Per-category generation budgets and memory-bounded batches
+    
+    budgets maps question_category to max_new_tokens (see learn_token_budgets). Questions are
+    grouped by budget and ordered by expected total length (prompt + budget). A batch grows
+    while its KV cache (bytes_per_token for every row's padded prompt + budget) and logits
+    (bytes_per_row) fit in memory_mb. After an out-of-memory error, later batches are
+    capped at half the size that failed.
+    """
+    
+    def __init__(self, budgets=None, memory_mb=None, bytes_per_token=None, bytes_per_row=0, max_batch_size=None):
+        self.budgets = budgets or {}
+        self.memory_bytes = memory_mb * 1024 * 1024 if memory_mb and bytes_per_token else None
+        self.bytes_per_token = bytes_per_token
+        self.bytes_per_row = bytes_per_row
+        self.max_batch_size = max_batch_size
+    
+    @classmethod
+    def for_model(cls, model, budgets=None, memory_mb=None, max_batch_size=None):
+        """Memory estimates from the model's config (no memory bound without a model)"""
+        if model is None:
+            return cls(budgets, max_batch_size=max_batch_size)
+        config = getattr(model.config, "text_config", model.config)
+        # Last-position logits, warped scores and probabilities are float32 per row
+        return cls(budgets, memory_mb, kv_cache_bytes_per_token(model), config.vocab_size * 4 * 3, max_batch_size)
+    
+    def budget(self, question):
+        return self.budgets.get(question['question_category'], GENERATION_KWARGS['max_new_tokens'])
+    
+    def fits(self, rows, tokens):
+        if rows > 1 and self.max_batch_size and rows > self.max_batch_size:
+            return False
+        if rows == 1 or self.memory_bytes is None:
+            return True
+        return rows * (tokens * self.bytes_per_token + self.bytes_per_row) <= self.memory_bytes
+    
+    def batches(self, backend, items):
+        """Yield (budget, batch) pairs; sizes are decided lazily so a backoff applies to the rest"""
+        lengths = backend.prompt_lengths([q for _, q in items])
+        budgets = [self.budget(q) for _, q in items]
+        order = sorted(range(len(items)), key=lambda k: (budgets[k], lengths[k] + budgets[k]))
+        
+        batch = []
+        for k in order:
+            if batch and (budgets[k] != budgets[batch[0]] or
+                          not self.fits(len(batch) + 1, max(lengths[j] for j in batch + [k]) + budgets[k])):
+                yield budgets[batch[0]], [items[j] for j in batch]
+                batch = []
+            batch.append(k)
+        if batch:
+            yield budgets[batch[0]], [items[j] for j in batch]
+    
+    def back_off(self, failed_rows):
+        self.max_batch_size = max(1, failed_rows // 2)
+
+def generate_with_backoff(backend, questions, scheduler=None):
+    """Generate a batch, splitting it in half on out-of-memory errors
+    
+    Returns ([responses], [metrics]); a question that doesn't fit even on its own gets
+    None, so it is left unanswered (and retried by --resume) instead of stored as an error.
+    """
+    try:
+        if len(questions) == 1:
+            response, metrics = backend.generate_one(questions[0])
+            return [response], [metrics]
+        return backend.generate_batch(questions)
+    except Exception as e:
+        if not is_out_of_memory(e):
+            raise
+    
+    free_memory()
+    if len(questions) == 1:
+        print(f"⚠️  Question {questions[0]['question_id']} does not fit in memory on its own; left unanswered")
+        return [None], [{}]
+    
+    half = len(questions) // 2
+    print(f"⚠️  Out of memory on a batch of {len(questions)}; retrying as {half} + {len(questions) - half}")
+    if scheduler is not None:
+        scheduler.back_off(len(questions))
+    first = generate_with_backoff(backend, questions[:half], scheduler)
+    second = generate_with_backoff(backend, questions[half:], scheduler)
+    return first[0] + second[0], first[1] + second[1]
+
+def generate_samples_with_backoff(backend, question, seeds):
+    """Draw one sample per seed, splitting the seeds in half on out-of-memory errors
+    
+    Each sample has its own seeded generator, so a split gives the same samples. Returns
+    (None, None) if even a single sample doesn't fit, leaving the question for --resume.
+    """
+    try:
+        return backend.generate_samples(question, seeds)
+    except Exception as e:
+        if not is_out_of_memory(e):
+            raise
+    
+    free_memory()
+    if len(seeds) == 1:
+        print(f"⚠️  Question {question['question_id']} does not fit in memory even for one sample; left unanswered")
+        return None, None
+    
+    half = len(seeds) // 2
+    print(f"⚠️  Out of memory on {len(seeds)} samples; retrying as {half} + {len(seeds) - half}")
+    first = generate_samples_with_backoff(backend, question, seeds[:half])
+    second = generate_samples_with_backoff(backend, question, seeds[half:])
+    if first[0] is None or second[0] is None:
+        return None, None
+    return first[0] + second[0], first[1] + second[1]
+
+def results_stream_path(output_file):
+    """Path of the JSONL stream that backs a results file"""
+    stream_path = os.path.splitext(output_file)[0] + ".jsonl"
+    if os.path.abspath(stream_path) == os.path.abspath(output_file):
+        # The final file would overwrite the stream that --resume reads
+        raise ValueError(f"{output_file} is the results stream itself; write the results to a .csv or .json file")
+    return stream_path
+
+def read_stream(stream_path):
+    """Yield the rows of a results stream, reporting (not raising on) lines that aren't valid JSON"""
+    bad = 0
+    with open(stream_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                row = None
+            if isinstance(row, dict) and 'question_id' in row:
+                yield row
+            elif line.strip():
+                bad += 1
+    if bad:
+        print(f"⚠️  Skipped {bad} unreadable lines in {stream_path}")
+
+def load_completed_results(stream_path, samples_per_question=1):
+    """Return the question_ids that already have successful answers (all samples) in the stream"""
+    completed = set()
+    if not os.path.exists(stream_path):
+        return completed
+    
+    # A crash can leave a torn last line behind; cut it so appended rows start cleanly
+    with open(stream_path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+    
+    answered = {}
+    for row in read_stream(stream_path):
+        # Failed generations are retried on resume
+        if not str(row.get('response')).startswith("Error:"):
+            answered.setdefault(str(row['question_id']), set()).add(row.get('sample_index', 0))
+    
+    for question_id, samples in answered.items():
+        if len(samples) >= samples_per_question:
+            completed.add(question_id)
+    
+    return completed
+
+def append_results(stream, rows):
+    """Append result rows to the stream and make them durable"""
+    for row in rows:
+        stream.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+    stream.flush()
+    os.fsync(stream.fileno())
+
+def report_time_to_first_question():
+    """Print how long this process took from start-up to its first stored answer"""
+    print(f"⏱️  Time to first question: {time.perf_counter() - STARTUP_TIME:.1f}s after start-up")
+
+def write_results_file(stream_path, output_file, question_ids):
+    """Build the final CSV or JSON results file from the stream, in question order"""
+    import pandas as pd
+    
+    latest = {}
+    for row in read_stream(stream_path):
+        # Later rows win, so a retried question replaces its earlier error
+        latest.setdefault(str(row['question_id']), {})[row.get('sample_index', 0)] = row
+    
+    results_df = pd.DataFrame([
+        samples[index]
+        for samples in (latest[str(qid)] for qid in question_ids if str(qid) in latest)
+        for index in sorted(samples)
+    ])
+    
+    if output_file.endswith(".json"):
+        results_df.to_json(output_file, orient="records", force_ascii=False, indent=2)
+    else:
+        results_df.to_csv(output_file, index=False)
+    
+    return results_df
+
+class QuestionProfiler:
+    """Runs cProfile or torch.profiler around the batches that contain a chosen range of questions"""
+    
+    def __init__(self, kind="cprofile", start=0, stop=None, output="gemma3_profile"):
+        self.kind = kind
+        self.start = start
+        self.stop = stop
+        self.output = output
+        self.batches = 0
+        self.profile = None
+        if kind == "cprofile":
+            import cProfile
+            self.profile = cProfile.Profile()
+    
+    def wants(self, indices):
+        return any(self.start <= i and (self.stop is None or i < self.stop) for i in indices)
+    
+    @contextlib.contextmanager
+    def __call__(self, indices):
+        if not self.wants(indices):
+            yield
+            return
+        
+        self.batches += 1
+        if self.kind == "cprofile":
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+        else:
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities) as prof:
+                yield
+            # One Chrome trace per profiled batch
+            os.makedirs(self.output, exist_ok=True)
+            prof.export_chrome_trace(os.path.join(self.output, f"batch_{self.batches}.json"))
+            print(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+    
+    def report(self):
+        """Save the collected profile"""
+        if self.batches == 0:
+            print("⚠️  Profiler range matched no questions")
+        elif self.kind == "cprofile":
+            import pstats
+            self.profile.dump_stats(f"{self.output}.prof")
+            pstats.Stats(self.profile).sort_stats("cumulative").print_stats(20)
+            print(f"✓ cProfile stats saved to {self.output}.prof")
+        else:
+            print(f"✓ torch.profiler traces saved to {self.output}/")
+
+def summarize_metrics(results_df, wall_time=None):
+    """Print per-category latency percentiles and overall throughput"""
+    if 'total_s' not in results_df.columns or results_df['total_s'].notna().sum() == 0:
+        return
+    
+    timed = results_df[results_df['total_s'].notna()]
+    print("\n⏱️  Latency per category (seconds):")
+    stats = timed.groupby('question_category')['total_s'].quantile([0.5, 0.95, 0.99]).unstack()
+    stats.columns = ['p50', 'p95', 'p99']
+    stats['ttft_p50'] = timed.groupby('question_category')['ttft_s'].median()
+    stats['questions'] = timed.groupby('question_category').size()
+    print(stats.round(3).to_string())
+    
+    generated = timed['generated_tokens'].sum()
+    print(f"\n📈 Generated {int(generated)} tokens; median decode speed "
+          f"{timed['decode_tokens_per_s'].median():.1f} tokens/sec per question")
+    if wall_time:
+        print(f"📈 Overall throughput: {generated / wall_time:.1f} tokens/sec over {wall_time:.1f}s")
+    if timed['peak_rss_mb'].notna().any():
+        print(f"📈 Peak RSS: {timed['peak_rss_mb'].max():.0f} MB")
+    if 'acceptance_rate' in timed.columns and timed['acceptance_rate'].notna().any():
+        print(f"📈 Prompt lookup: {timed['acceptance_rate'].mean() * 100:.1f}% of draft tokens accepted")
+
+class TransformersBackend:
+    """Generation backend for a model/tokenizer pair loaded by setup_gemma3_model
+    
+    A backend answers question records ({question_id, question_category, question}).
+    Any object with the same methods can be passed to run_benchmark, e.g. the
+    MockBackend in run_benchmark_demo.py.
+    """
+    
+    def __init__(self, model, tokenizer, system_prompt=None, prefix_cache=None, prompt_store=None, prompt_lookup=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.system_prompt = system_prompt
+        self.prefix_cache = prefix_cache
+        self.prompt_store = prompt_store
+        self.prompt_lookup = prompt_lookup
+    
+    def identity(self):
+        """What the response cache keys on besides the prompt"""
+        identity = get_model_identity(self.model)
+        if self.prompt_lookup is not None:
+            # Drafts change how sampling consumes random numbers (greedy output is unaffected)
+            identity['prompt_lookup'] = self.prompt_lookup
+        return identity
+    
+    def prompt(self, question):
+        return build_prompt(question['question'], self.system_prompt)
+    
+    def _stored(self, questions):
+        """Pre-tokenized prompts for the questions, or None unless all of them are in the store"""
+        store = self.prompt_store
+        if store is None or not all(q['question_id'] in store for q in questions):
+            return None
+        return [store.get(q['question_id']) for q in questions]
+    
+    def prompt_lengths(self, questions):
+        if self._stored(questions) is None:
+            return prompt_lengths(self.tokenizer, [q['question'] for q in questions], self.system_prompt)
+        # Lengths come straight from the store's offsets index
+        return [self.prompt_store.length(q['question_id']) for q in questions]
+    
+    def bucket(self, questions, batch_size):
+        return bucket_by_length(self.prompt_lengths(questions), batch_size)
+    
+    def seed(self, seed):
+        import torch
+        torch.manual_seed(seed)
+    
+    def generate_one(self, question):
+        """Return (response, metrics) for one question"""
+        token_ids = self._stored([question])
+        return generate_response(self.model, self.tokenizer, question['question'], system_prompt=self.system_prompt,
+                                 prefix_cache=self.prefix_cache, return_metrics=True,
+                                 token_ids=token_ids[0] if token_ids is not None else None,
+                                 prompt_lookup=self.prompt_lookup)
+    
+    def generate_batch(self, questions):
+        """Return ([responses], [metrics]) for a batch of questions"""
+        if self.prompt_lookup is not None:
+            # Drafts are verified one sequence at a time
+            results = [self.generate_one(q) for q in questions]
+            return [response for response, _ in results], [metrics for _, metrics in results]
+        return generate_batch_responses(self.model, self.tokenizer, [q['question'] for q in questions],
+                                        self.system_prompt, self.prefix_cache, return_metrics=True,
+                                        token_ids=self._stored(questions))
+    
+    def generate_samples(self, question, seeds):
+        """Return ([responses], [metrics]) with one sample per seed, sharing a single prefill"""
+        token_ids = self._stored([question])
+        return generate_samples(self.model, self.tokenizer, question['question'], seeds, self.system_prompt,
+                                self.prefix_cache, token_ids[0] if token_ids is not None else None)
+
+def answer_questions_sampled(backend, items, total, samples_per_question, cache=None, seed=None, profiler=None,
+                             scheduler=None, skipped=None):
+    """Answer each question with several samples drawn from one prefill, yielding one question's rows at a time
+    
+    With a TokenBudgetScheduler, each question is generated under its category's budget. A
+    question whose samples don't fit in memory gets no rows and is appended to skipped.
+    """
+    backend_id = backend.identity() if cache is not None else None
+    
+    for i, q in items:
+        budget = scheduler.budget(q) if scheduler is not None else None
+        with generation_overrides(max_new_tokens=budget) if budget is not None else contextlib.nullcontext():
+            rows = _answer_samples(backend, i, q, total, samples_per_question, cache, backend_id, seed, profiler)
+        if not rows and skipped is not None:
+            skipped.append(str(q['question_id']))
+        yield rows
+
+def _answer_samples(backend, i, q, total, samples_per_question, cache, backend_id, seed, profiler):
+    """Result rows for every sample of one question under the current GENERATION_KWARGS"""
+    # The number of samples is part of what a cached entry holds
+    cache_kwargs = {**generation_settings(), 'samples_per_question': samples_per_question}
+    responses = metrics = None
+    
+    if cache is not None:
+        key = ResponseCache.make_key(backend_id, backend.prompt(q), cache_kwargs, seed)
+        cached = cache.get(key)
+        if cached is not None:
+            entry = json.loads(cached)
+            responses, seeds = entry['responses'], entry['seeds']
+            metrics = [{}] * samples_per_question
+    
+    if responses is None:
+        seeds = sample_seeds(seed, q['question_id'], samples_per_question)
+        print(f"Processing question {i + 1}/{total} (ID: {q['question_id']}, {samples_per_question} samples)")
+        with profiler([i]) if profiler is not None else contextlib.nullcontext():
+            responses, metrics = generate_samples_with_backoff(backend, q, seeds)
+        if responses is None:
+            return []
+        
+        if cache is not None and not any(response.startswith("Error:") for response in responses):
+            cache.put(key, json.dumps({'responses': responses, 'seeds': seeds}, ensure_ascii=False))
+    
+    return [{
+        'question_id': q['question_id'],
+        'question_category': q['question_category'],
+        'question': q['question'],
+        'sample_index': index,
+        'sample_seed': sample_seed,
+        'response': response,
+        'timestamp': datetime.now().isoformat(),
+        'max_new_tokens': GENERATION_KWARGS['max_new_tokens'],
+        **{column: m.get(column) for column in METRIC_COLUMNS}
+    } for index, (sample_seed, response, m) in enumerate(zip(seeds, responses, metrics))]
+
+def answer_questions(backend, items, total, batch_size=1, cache=None, seed=None, profiler=None,
+                     samples_per_question=1, scheduler=None, skipped=None):
+    """Answer (index, question) items, yielding the result rows of one batch at a time
+    
+    With a TokenBudgetScheduler, batches follow its per-category budgets and memory bound.
+    Batches that run out of memory are split and retried; a question that doesn't fit on its
+    own gets no row, and its question_id is appended to skipped (if given).
+    """
+    if samples_per_question > 1:
+        yield from answer_questions_sampled(backend, items, total, samples_per_question, cache, seed, profiler,
+                                            scheduler, skipped)
+        return
+    
+    if scheduler is not None:
+        batches = scheduler.batches(backend, items)
+        print(f"📦 Token-budget mode: batches grouped by category budget, up to {batch_size} questions")
+    elif batch_size > 1:
+        buckets = backend.bucket([q for _, q in items], batch_size)
+        batches = [(None, [items[j] for j in bucket]) for bucket in buckets]
+        print(f"📦 Batched mode: {len(batches)} batches of up to {batch_size} questions")
+    else:
+        batches = [(None, [item]) for item in items]
+    
+    backend_id = backend.identity() if cache is not None else None
+    
+    for budget, batch in batches:
+        with generation_overrides(max_new_tokens=budget) if budget is not None else contextlib.nullcontext():
+            rows = _answer_batch(backend, batch, total, cache, backend_id, seed, profiler, scheduler)
+        if skipped is not None:
+            answered = {str(row['question_id']) for row in rows}
+            skipped.extend(str(q['question_id']) for _, q in batch if str(q['question_id']) not in answered)
+        yield rows
+
+def _answer_batch(backend, batch, total, cache, backend_id, seed, profiler, scheduler):
+    """Result rows for one batch under the current GENERATION_KWARGS"""
+    responses = {}
+    metrics = {}
+    
+    # Serve what we can from the response cache
+    if cache is not None:
+        keys = {i: ResponseCache.make_key(backend_id, backend.prompt(q), generation_settings(), seed)
+                for i, q in batch}
+        for i, _ in batch:
+            cached = cache.get(keys[i])
+            if cached is not None:
+                responses[i] = cached
+    
+    misses = [(i, q) for i, q in batch if i not in responses]
+    
+    if seed is not None and misses:
+        backend.seed(seed)
+    
+    with profiler([i for i, _ in misses]) if profiler is not None else contextlib.nullcontext():
+        if len(misses) > 1:
+            print(f"Processing batch of {len(misses)} questions (IDs: {', '.join(str(q['question_id']) for _, q in misses)})")
+            generated, batch_metrics = generate_with_backoff(backend, [q for _, q in misses], scheduler)
+            
+            # If the whole batch failed, fall back to one question at a time so a bad question stays isolated
+            if all(response is not None and response.startswith("Error:") for response in generated):
+                print("🔄 Retrying batch one question at a time...")
+            else:
+                responses.update((i, response) for (i, _), response in zip(misses, generated))
+                metrics.update((i, m) for (i, _), m in zip(misses, batch_metrics))
+        
+        for i, q in misses:
+            if i not in responses:
+                print(f"Processing question {i + 1}/{total} (ID: {q['question_id']})")
+                [responses[i]], [metrics[i]] = generate_with_backoff(backend, [q], scheduler)
+    
+    if cache is not None:
+        for i, _ in misses:
+            if responses[i] is not None and not responses[i].startswith("Error:"):
+                cache.put(keys[i], responses[i])
+    
+    return [{
+        'question_id': q['question_id'],
+        'question_category': q['question_category'],
+        'question': q['question'],
+        'response': responses[i],
+        'timestamp': datetime.now().isoformat(),
+        'max_new_tokens': GENERATION_KWARGS['max_new_tokens'],
+        **{column: metrics.get(i, {}).get(column) for column in METRIC_COLUMNS}
+    } for i, q in batch if responses[i] is not None]
+
+def prepare_run(questions_df, output_file, resume, samples_per_question=1):
+    """Return the question records, the results stream path and the (index, question) items still to answer"""
+    questions = questions_df[['question_id', 'question_category', 'question']].to_dict("records")
+    
+    # Every result is appended to a JSONL stream as soon as it finishes
+    stream_path = results_stream_path(output_file)
+    completed_ids = load_completed_results(stream_path, samples_per_question) if resume else set()
+    pending = [(i, q) for i, q in enumerate(questions) if str(q['question_id']) not in completed_ids]
+    
+    if resume:
+        print(f"↩️  Resuming from {stream_path}: {len(questions) - len(pending)} questions already answered")
+    
+    return questions, stream_path, pending
+
+def open_prompt_store(root, questions, tokenizer, system_prompt=None):
+    """Open (or build) the pre-tokenized prompt store for these questions and this tokenizer/template"""
+    from prompt_store import PromptStore
+    return PromptStore.open_or_build(root, questions, tokenizer, lambda q: build_prompt(q, system_prompt),
+                                     max_length=1024)
+
+def run_benchmark(model, tokenizer, questions_df, output_file="gemma3_results.csv", batch_size=1, resume=False,
+                  cache=None, seed=None, system_prompt=None, prefix_cache=None, profiler=None, backend=None,
+                  prompt_store=None, samples_per_question=1, prompt_lookup=None, token_budgets=None,
+                  batch_memory_mb=None):
+    """Run the model (or a custom generation backend) on all benchmark questions
+    
+    With samples_per_question > 1 every question gets that many rows (sample_index/sample_seed columns).
+    prompt_lookup ({'ngram_size', 'num_tokens'}) enables prompt-lookup speculative decoding.
+    token_budgets ({category: max_new_tokens}) and batch_memory_mb switch batching to a TokenBudgetScheduler.
+    """
     print(f"🔄 Running benchmark on {len(questions_df)} questions...")
+    run_start = time.perf_counter()
+    
+    questions, stream_path, pending = prepare_run(questions_df, output_file, resume, samples_per_question)
+    
+    if backend is None:
+        if isinstance(prompt_store, str):
+            prompt_store = open_prompt_store(prompt_store, questions, tokenizer, system_prompt)
+        backend = TransformersBackend(model, tokenizer, system_prompt, prefix_cache, prompt_store, prompt_lookup)
     
-    results = []
+    scheduler = None
+    if token_budgets is not None or batch_memory_mb is not None:
+        scheduler = TokenBudgetScheduler.for_model(model, token_budgets, batch_memory_mb, batch_size)
+        if batch_memory_mb is not None and (batch_size == 1 or samples_per_question > 1):
+            print("⚠️  batch_memory_mb only applies to batches of several questions; it is ignored for this run")
+
+    completed = len(questions) - len(pending)
+    first = True
+    
+    with open(stream_path, 'a' if resume else 'w', encoding='utf-8') as stream:
+        for rows in answer_questions(backend, pending, len(questions), batch_size, cache, seed, profiler,
+                                     samples_per_question, scheduler):
+            # Store results
+            append_results(stream, rows)
+            if first:
+                report_time_to_first_question()
+                first = False
+            
+            # Print progress every 10 questions
+            previous, completed = completed, completed + len({str(row['question_id']) for row in rows})
+            if completed // 10 > previous // 10:
+                print(f"✓ Completed {completed} questions")
+    
+    # Build the final results file from the stream
+    results_df = write_results_file(stream_path, output_file, [q['question_id'] for q in questions])
+    print(f"✓ Results saved to {output_file}")
+    
+    unanswered = len(questions) - (results_df['question_id'].astype(str).nunique() if len(results_df) else 0)
+    if unanswered:
+        print(f"⚠️  {unanswered} questions have no answer yet; run again with --resume to retry them")
+    
+    summarize_metrics(results_df, time.perf_counter() - run_start)
+    
+    if cache is not None:
+        cache.report()
+    if profiler is not None:
+        profiler.report()
+    
+    return results_df
+
+def _benchmark_worker(worker_id, num_threads, task_queue, result_queue, total, options):
+    """Worker process: load the model once, then answer shards from the shared queue"""
+    backend = options['backend']
+    # Spawned workers start from the module defaults
+    STOP_STRINGS[:] = options['stop_strings']
     
-    for idx, row in questions_df.iterrows():
-        question_id = row['question_id']
-        category = row['question_category']
-        question = row['question']
+    if backend is None:
+        if options['cpu'] is not None:
+            model, tokenizer = setup_cpu_model(**{**options['cpu'], 'threads': num_threads})
+        else:
+            import torch
+            torch.set_num_threads(num_threads)
+            
+            model, tokenizer = setup_gemma3_model()
+        if model is None or tokenizer is None:
+            result_queue.put(('failed', worker_id, "Failed to load model"))
+            return
+        
+        system_prompt = options['system_prompt']
+        prefix_cache = PrefixCache(model, tokenizer, system_prompt) if options['prefix_cache'] else None
+        
+        # Every worker memory-maps the same store; only the first one to get here builds it
+        prompt_store = None
+        if options['prompt_store'] is not None:
+            prompt_store = open_prompt_store(options['prompt_store'], options['questions'], tokenizer, system_prompt)
         
-        print(f"Processing question {idx + 1}/{len(questions_df)} (ID: {question_id})")
+        backend = TransformersBackend(model, tokenizer, system_prompt, prefix_cache, prompt_store,
+                                      options['prompt_lookup'])
+    
+    scheduler = None
+    if options['token_budgets'] is not None or options['batch_memory_mb'] is not None:
+        scheduler = TokenBudgetScheduler.for_model(getattr(backend, 'model', None), options['token_budgets'],
+                                                   options['batch_memory_mb'], options['batch_size'])
+    
+    cache_kwargs = options['cache_kwargs']
+    cache = ResponseCache(**cache_kwargs) if cache_kwargs is not None else None
+    
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
         
-        # Generate response
-        response = generate_response(model, tokenizer, question)
+        shard_id, items = task
+        result_queue.put(('started', worker_id, shard_id))
         
-        # Store result
-        results.append({
-            'question_id': question_id,
-            'question_category': category,
-            'question': question,
-            'response': response,
+        skipped = []
+        try:
+            for rows in answer_questions(backend, items, total, options['batch_size'], cache, options['seed'],
+                                         samples_per_question=options['samples_per_question'],
+                                         scheduler=scheduler, skipped=skipped):
+                result_queue.put(('rows', worker_id, rows))
+        except Exception as e:
+            print(f"❌ Worker {worker_id} failed on shard {shard_id}: {e}")
+        
+        # Questions left unanswered on purpose (out of memory on their own) stay open for --resume
+        if skipped:
+            result_queue.put(('skipped', worker_id, skipped))
+        result_queue.put(('finished', worker_id, shard_id))
+    
+    stats = (cache.hits, cache.misses) if cache is not None else None
+    if cache is not None:
+        cache.close()
+    result_queue.put(('done', worker_id, stats))
+
+def run_benchmark_parallel(questions_df, output_file="gemma3_results.csv", num_workers=2, threads_per_worker=None,
+                           shard_size=8, batch_size=1, resume=False, cache_kwargs=None, seed=None,
+                           system_prompt=None, prefix_cache=False, backend=None, prompt_store=None,
+                           samples_per_question=1, prompt_lookup=None, cpu=None, token_budgets=None,
+                           batch_memory_mb=None):
+    """Run the benchmark across worker processes that each load their own copy of the model
+    
+    A picklable backend (e.g. MockBackend) is copied to every worker instead of loading the model.
+    cpu holds setup_cpu_model keyword arguments to load the CPU backend instead of setup_gemma3_model.
+    """
+    import multiprocessing as mp
+    import queue
+    
+    print(f"🔄 Running benchmark on {len(questions_df)} questions with {num_workers} workers...")
+    run_start = time.perf_counter()
+    
+    questions, stream_path, pending = prepare_run(questions_df, output_file, resume, samples_per_question)
+    completed = len(questions) - len(pending)
+    
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+    
+    shards = {shard_id: pending[start:start + shard_size]
+              for shard_id, start in enumerate(range(0, len(pending), shard_size))}
+    
+    # Spawned workers don't inherit the parent's torch/CUDA state
+    ctx = mp.get_context("spawn")
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for shard_id, items in shards.items():
+        task_queue.put((shard_id, items))
+    for _ in range(num_workers):
+        task_queue.put(None)
+    
+    options = {
+        'batch_size': batch_size,
+        'cache_kwargs': cache_kwargs,
+        'seed': seed,
+        'system_prompt': system_prompt,
+        'prefix_cache': prefix_cache,
+        'backend': backend,
+        'prompt_store': prompt_store,
+        'samples_per_question': samples_per_question,
+        'stop_strings': list(STOP_STRINGS),
+        'prompt_lookup': prompt_lookup,
+        'cpu': cpu,
+        'token_budgets': token_budgets,
+        'batch_memory_mb': batch_memory_mb,
+        # Needed to build the prompt store if it doesn't exist yet
+        'questions': questions if prompt_store is not None and backend is None else None,
+    }
+    
+    workers = {}
+    for worker_id in range(num_workers):
+        worker = ctx.Process(target=_benchmark_worker, args=(worker_id, threads_per_worker, task_queue, result_queue,
+                                                             len(questions), options))
+        worker.start()
+        workers[worker_id] = worker
+    print(f"✓ Started {num_workers} workers with {threads_per_worker} torch threads each")
+    
+    in_flight = {}      # worker_id -> shard_id being answered
+    answered = set()    # question_ids with a result row (or deliberately left without one)
+    unanswered = 0
+    running = set(workers)
+    hits = misses = 0
+    first = True
+    
+    def error_rows(items, message):
+        return [{
+            'question_id': q['question_id'],
+            'question_category': q['question_category'],
+            'question': q['question'],
+            'response': f"Error: {message}",
             'timestamp': datetime.now().isoformat()
-        })
+        } for _, q in items if str(q['question_id']) not in answered]
+    
+    with open(stream_path, 'a' if resume else 'w', encoding='utf-8') as stream:
+        def store(rows):
+            nonlocal completed, first
+            append_results(stream, rows)
+            if first:
+                report_time_to_first_question()
+                first = False
+            previous, completed = completed, completed + len({str(row['question_id']) for row in rows})
+            if completed // 10 > previous // 10:
+                print(f"✓ Completed {completed} questions")
+        
+        while running:
+            try:
+                kind, worker_id, payload = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                # A worker that died without saying goodbye loses only its current shard
+                for worker_id in list(running):
+                    exitcode = workers[worker_id].exitcode
+                    if exitcode is not None:
+                        running.discard(worker_id)
+                        shard_id = in_flight.pop(worker_id, None)
+                        if shard_id is not None:
+                            print(f"❌ Worker {worker_id} exited with code {exitcode} during shard {shard_id}")
+                            store(error_rows(shards[shard_id], f"worker {worker_id} exited with code {exitcode}"))
+                            # Recorded now, so the leftover pass below doesn't store them again
+                            answered.update(str(q['question_id']) for _, q in shards[shard_id])
+                continue
+            
+            if kind == 'started':
+                in_flight[worker_id] = payload
+            elif kind == 'rows':
+                answered.update(str(row['question_id']) for row in payload)
+                store(payload)
+            elif kind == 'skipped':
+                answered.update(payload)
+                unanswered += len(payload)
+            elif kind == 'finished':
+                # Anything the shard didn't answer (e.g. an exception mid-shard) is recorded as an error
+                rows = error_rows(shards[payload], f"worker {worker_id} failed on this question")
+                if rows:
+                    store(rows)
+                answered.update(str(q['question_id']) for _, q in shards[payload])
+                in_flight.pop(worker_id, None)
+            elif kind in ('done', 'failed'):
+                running.discard(worker_id)
+                if kind == 'failed':
+                    print(f"❌ Worker {worker_id}: {payload}")
+                elif payload is not None:
+                    hits += payload[0]
+                    misses += payload[1]
         
-        # Print progress every 10 questions
-        if (idx + 1) % 10 == 0:
-            print(f"✓ Completed {idx + 1} questions")
+        # Shards nobody picked up (e.g. every worker failed to load the model)
+        leftover = error_rows([item for items in shards.values() for item in items], "no worker available")
+        if leftover:
+            store(leftover)
+    
+    for worker in workers.values():
+        worker.join()
     
-    # Save results to CSV
-    results_df = pd.DataFrame(results)
-    results_df.to_csv(output_file, index=False)
+    # Merge everything back into question order
+    results_df = write_results_file(stream_path, output_file, [q['question_id'] for q in questions])
     print(f"✓ Results saved to {output_file}")
     
+    if unanswered:
+        print(f"⚠️  {unanswered} questions have no answer yet; run again with --resume to retry them")
+    
+    summarize_metrics(results_df, time.perf_counter() - run_start)
+    
+    if cache_kwargs is not None:
+        total = hits + misses
+        rate = hits / total * 100 if total else 0.0
+        print(f"🗄️  Cache: {hits} hits, {misses} misses ({rate:.1f}% hit rate) - {cache_kwargs['path']}")
+    
     return results_df
 
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Run Gemma-3 270M on the Pico-Saudi-LLMs-Benchmark")
+    parser.add_argument("--csv", default=DEFAULT_CSV_PATH, help="Path to the benchmark questions CSV")
+    parser.add_argument("--output", default="gemma3_results.csv",
+                        help="Where to write the results (.csv or .json, not .jsonl); rows are streamed to a matching .jsonl")
+    parser.add_argument("--categories", default=None,
+                        help="Comma-separated question categories to run (e.g. reasoning,coding)")
+    parser.add_argument("--question-ids", default=None, help="Comma-separated question_ids to run")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="Questions per generate call; >1 enables length-bucketed batching "
+                             f"(default: 1, or up to {MEMORY_BOUND_BATCH_SIZE} as memory allows with --batch-memory-mb)")
+    parser.add_argument("--token-budgets", nargs="+", default=None, metavar="RESULTS",
+                        help="Learn per-category max_new_tokens from earlier results files or results store directories")
+    parser.add_argument("--batch-memory-mb", type=float, default=None,
+                        help="Size batches so their KV cache and logits fit in this much memory")
+    parser.add_argument("--samples-per-question", type=int, default=1,
+                        help="Responses drawn per question from a single shared prefill (pass@k / self-consistency)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip questions already answered in the results stream and carry on")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for sampling")
+    parser.add_argument("--cache", default="gemma3_cache.sqlite", help="Response cache database")
+    parser.add_argument("--cache-size-mb", type=float, default=512,
+                        help="Evict least recently used responses beyond this size")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache entirely")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="Ignore cached responses but store the newly generated ones")
+    parser.add_argument("--system-prompt", nargs="?", const=SYSTEM_PROMPT, default=None,
+                        help=f"Instruction placed at the start of every user turn (bare flag: '{SYSTEM_PROMPT}')")
+    parser.add_argument("--stop", action="append", default=[],
+                        help="Extra stop string (repeatable); generation always stops at <end_of_turn> and EOS")
+    parser.add_argument("--prefix-cache", action="store_true",
+                        help="Prefill the shared template prefix once and reuse its KV cache for every question")
+    parser.add_argument("--profile", choices=["cprofile", "torch"], default=None,
+                        help="Attach a profiler to the questions selected by --profile-range")
+    parser.add_argument("--profile-range", default="0:10",
+                        help="START:STOP question positions to profile (default: 0:10)")
+    parser.add_argument("--profile-output", default="gemma3_profile",
+                        help="cProfile stats file stem or torch.profiler trace directory")
+    parser.add_argument("--prompt-lookup", action="store_true",
+                        help="Speculative decoding with draft tokens copied from n-grams of the prompt/answer so far")
+    parser.add_argument("--lookup-ngram-size", type=int, default=3,
+                        help="Longest n-gram matched to find prompt-lookup drafts")
+    parser.add_argument("--lookup-num-tokens", type=int, default=10,
+                        help="Draft tokens verified per forward pass with --prompt-lookup")
+    parser.add_argument("--prompt-store", nargs="?", const=".prompt_store", default=None,
+                        help="Directory of memory-mapped pre-tokenized prompts (bare flag: .prompt_store)")
+    parser.add_argument("--backend", choices=["transformers", "cpu", "mock"], default="transformers",
+                        help="Generation backend; 'cpu' loads the plain checkpoint tuned for CPU inference, "
+                             "'mock' answers without a model (see run_benchmark_demo.py)")
+    parser.add_argument("--cpu-dtype", choices=["float32", "bfloat16"], default="float32",
+                        help="Weight dtype for the CPU backend")
+    parser.add_argument("--int8", action="store_true",
+                        help="CPU backend: dynamically quantize the Linear layers to int8")
+    parser.add_argument("--compile", action="store_true",
+                        help="CPU backend: static KV cache with a torch.compile'd decode step (warmed up at load)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="CPU backend: intra-op torch threads (default: torch's choice)")
+    parser.add_argument("--interop-threads", type=int, default=None,
+                        help="CPU backend: inter-op torch threads")
+    parser.add_argument("--cpu-speedup", type=int, default=0, metavar="N",
+                        help="CPU backend: before the run, time N questions against the float16 path and report the speedup")
+    parser.add_argument("--mock-token-latency", type=float, default=0.0,
+                        help="Seconds per decode step for the mock backend")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes, each with its own copy of the model")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="Torch threads per worker (default: CPU cores / workers)")
+    parser.add_argument("--shard-size", type=int, default=8, help="Questions handed to a worker at a time")
+    parser.add_argument("--results-store", nargs="?", const="gemma3_results_store", default=None,
+                        help="Also add the run to this columnar results store (bare flag: gemma3_results_store)")
+    parser.add_argument("--run-id", default=None, help="Run name in the results store (default: current time)")
+    args = parser.parse_args(argv)
+    
+    if args.output.endswith(".jsonl"):
+        parser.error("--output must be a .csv or .json file; the matching .jsonl is the results stream")
+    if args.batch_memory_mb is not None and args.samples_per_question > 1:
+        parser.error("--batch-memory-mb sizes batches of questions, but --samples-per-question answers "
+                     "one question at a time")
+    if args.batch_size is None:
+        # With a memory cap, the cap decides how many questions share a batch
+        args.batch_size = MEMORY_BOUND_BATCH_SIZE if args.batch_memory_mb is not None else 1
+    return args
+
 def main():
     """Main function"""
+    args = parse_args()
+    STOP_STRINGS[:] = args.stop
+    
     print("🚀 Gemma-3 270M GGUF Saudi LLMs Benchmark Runner")
     print("=" * 50)
     
-    # Check if running with proper setup
-    if not check_requirements():
+    backend = None
+    if args.backend == "mock":
+        from run_benchmark_demo import MockBackend
+        backend = MockBackend(token_latency=args.mock_token_latency)
+        print("📋 Backend: mock (no model is loaded)")
+    
+    # Check if running with proper setup (the CPU backend doesn't need unsloth)
+    elif not check_requirements(("torch", "transformers") if args.backend == "cpu" else
+                                ("torch", "transformers", "unsloth")):
         return
     
     # Load benchmark data
-    csv_path = "Pico-Saudi-LLMs-Benchmark/v0.01/Pico-Saudi-LLMs-Questions-v0.01.csv"
-    questions_df = load_benchmark_data(csv_path)
+    questions_df = load_benchmark_data(
+        args.csv,
+        categories=args.categories.split(",") if args.categories else None,
+        question_ids=args.question_ids.split(",") if args.question_ids else None,
+    )
     
     if questions_df is None:
         return
     
-    # Setup model
-    model, tokenizer = setup_gemma3_model()
+    prompt_lookup = None
+    if args.prompt_lookup:
+        prompt_lookup = {'ngram_size': args.lookup_ngram_size, 'num_tokens': args.lookup_num_tokens}
     
-    if model is None or tokenizer is None:
-        print("❌ Failed to load model. Exiting.")
-        return
+    token_budgets = learn_token_budgets(args.token_budgets) if args.token_budgets else None
     
-    # Run benchmark
-    print(f"🎯 Running benchmark with Gemma-3 270M GGUF")
-    print(f"📋 Model: unsloth/gemma-3-270m-it-GGUF")
-    print(f"📋 System prompt: 'You must provide all your responses exclusively in Arabic'")
+    cpu = None
+    if args.backend == "cpu":
+        cpu = {
+            'dtype': args.cpu_dtype,
+            'int8': args.int8,
+            'compile': args.compile,
+            'threads': args.threads,
+            'interop_threads': args.interop_threads,
+            'warmup_batch_sizes': sorted({1, args.batch_size}),
+        }
+    
+    cache_kwargs = None if args.no_cache else {
+        'path': args.cache,
+        'max_size_mb': args.cache_size_mb,
+        'refresh': args.refresh_cache,
+    }
+    
+    if args.workers > 1:
+        # Each worker loads its own model, so the parent never does
+        print(f"🎯 Running benchmark with Gemma-3 270M GGUF")
+        print(f"📋 Model: {CPU_MODEL_NAME if cpu is not None else MODEL_NAME}")
+        results_df = run_benchmark_parallel(questions_df, args.output, num_workers=args.workers,
+                                            threads_per_worker=args.threads_per_worker, shard_size=args.shard_size,
+                                            batch_size=args.batch_size, resume=args.resume,
+                                            cache_kwargs=cache_kwargs, seed=args.seed,
+                                            system_prompt=args.system_prompt, prefix_cache=args.prefix_cache,
+                                            backend=backend, prompt_store=args.prompt_store,
+                                            samples_per_question=args.samples_per_question,
+                                            prompt_lookup=prompt_lookup, cpu=cpu, token_budgets=token_budgets,
+                                            batch_memory_mb=args.batch_memory_mb)
+    else:
+        model = tokenizer = prefix_cache = None
+        
+        if backend is None:
+            # Setup model
+            model, tokenizer = setup_cpu_model(**cpu) if cpu is not None else setup_gemma3_model()
+            
+            if model is None or tokenizer is None:
+                print("❌ Failed to load model. Exiting.")
+                return
+            
+            if cpu is not None and args.cpu_speedup:
+                report_cpu_speedup(model, tokenizer, questions_df['question'].head(args.cpu_speedup).tolist())
+            
+            prefix_cache = PrefixCache(model, tokenizer, args.system_prompt) if args.prefix_cache else None
+        
+        # Run benchmark
+        print(f"🎯 Running benchmark with Gemma-3 270M GGUF")
+        print(f"📋 Model: {CPU_MODEL_NAME if cpu is not None else MODEL_NAME}")
+        print(f"📋 System prompt: '{args.system_prompt}'" if args.system_prompt else "📋 System prompt: none")
+        
+        cache = ResponseCache(**cache_kwargs) if cache_kwargs is not None else None
+        
+        profiler = None
+        if args.profile:
+            start, _, stop = args.profile_range.partition(":")
+            profiler = QuestionProfiler(args.profile, int(start or 0), int(stop) if stop else None,
+                                        args.profile_output)
+        
+        results_df = run_benchmark(model, tokenizer, questions_df, args.output,
+                                   batch_size=args.batch_size, resume=args.resume, cache=cache, seed=args.seed,
+                                   system_prompt=args.system_prompt, prefix_cache=prefix_cache, profiler=profiler,
+                                   backend=backend, prompt_store=args.prompt_store,
+                                   samples_per_question=args.samples_per_question, prompt_lookup=prompt_lookup,
+                                   token_budgets=token_budgets, batch_memory_mb=args.batch_memory_mb)
+        
+        if cache is not None:
+            cache.close()
     
-    results_df = run_benchmark(model, tokenizer, questions_df)
+    if args.results_store:
+        from results_store import write_run
+        model_name = "mock" if backend is not None else CPU_MODEL_NAME if cpu is not None else MODEL_NAME
+        write_run(results_df, args.results_store, run_id=args.run_id, model=model_name)
     
     print("=" * 50)
     print("✅ Benchmark completed successfully!")
     print(f"📊 Processed {len(results_df)} questions")
-    print("📁 Results saved to gemma3_results.csv")
+    print(f"📁 Results saved to {args.output}")
     
     # Display sample results
     print("\n📋 Sample Results:")
@@ -221,4 +2103,4 @@ def main():
         print(f"Response: {row['response'][:100]}...")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,136 @@
+"""
+Pre-tokenized prompt store
+Token ids of every formatted benchmark prompt, kept in one flat int32 array with an
+offsets index and memory-mapped from disk so worker processes share it without copying
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent builders each tokenize, and the first to publish wins
+    fcntl = None
+
+# Bump when the on-disk layout changes so old stores are ignored
+STORE_VERSION = "1"
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash that changes whenever the tokenizer's vocabulary or rules change"""
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode())
+    digest.update(str(getattr(tokenizer, "name_or_path", "")).encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # Fast tokenizers serialize their full model, normalizer and pre-tokenizer; the
+        # truncation/padding state changes from call to call, so it is left out
+        config = json.loads(backend.to_str())
+        config.pop("truncation", None)
+        config.pop("padding", None)
+        digest.update(json.dumps(config, sort_keys=True).encode())
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode())
+    digest.update(json.dumps(sorted(str(t) for t in tokenizer.all_special_tokens)).encode())
+    return digest.hexdigest()
+
+def dataset_fingerprint(questions):
+    """Hash of the question_ids and texts that make up the prompts"""
+    digest = hashlib.sha256()
+    for q in questions:
+        digest.update(str(q['question_id']).encode())
+        digest.update(b"\0")
+        digest.update(q['question'].encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class PromptStore:
+    """Memory-mapped token ids of formatted prompts, looked up by question_id"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.positions = {qid: i for i, qid in enumerate(index['question_ids'])}
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        ids_path = os.path.join(path, "ids.bin")
+        # np.memmap refuses empty files
+        self.ids = (np.memmap(ids_path, dtype=np.int32, mode='r') if os.path.getsize(ids_path)
+                    else np.zeros(0, dtype=np.int32))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, question_id):
+        return str(question_id) in self.positions
+
+    def get(self, question_id):
+        """Token ids of one prompt (a view into the memory map)"""
+        i = self.positions[str(question_id)]
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def length(self, question_id):
+        i = self.positions[str(question_id)]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    @staticmethod
+    def build(path, questions, tokenizer, build_prompt, max_length, chunksize=1024):
+        """Tokenize every prompt once and write the flat ids + offsets to path"""
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        offsets = [0]
+        with open(os.path.join(tmp_path, "ids.bin"), 'wb') as f:
+            for start in range(0, len(questions), chunksize):
+                chunk = questions[start:start + chunksize]
+                prompts = [build_prompt(q['question']) for q in chunk]
+                for ids in tokenizer(prompts, truncation=True, max_length=max_length)["input_ids"]:
+                    np.asarray(ids, dtype=np.int32).tofile(f)
+                    offsets.append(offsets[-1] + len(ids))
+
+        np.save(os.path.join(tmp_path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+        with open(os.path.join(tmp_path, "index.json"), 'w', encoding='utf-8') as f:
+            json.dump({'question_ids': [str(q['question_id']) for q in questions]}, f, ensure_ascii=False)
+
+        # Publish atomically; if another process got there first, keep theirs
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def open_or_build(cls, root, questions, tokenizer, build_prompt, max_length=1024):
+        """Open the store for this dataset/tokenizer/template/max_length, building it if needed"""
+        key = hashlib.sha256(json.dumps({
+            'version': STORE_VERSION,
+            'dataset': dataset_fingerprint(questions),
+            'tokenizer': tokenizer_fingerprint(tokenizer),
+            'template': build_prompt("{question}"),
+            'max_length': max_length,
+        }, sort_keys=True).encode()).hexdigest()[:16]
+        path = os.path.join(root, key)
+
+        if not os.path.exists(path):
+            os.makedirs(root, exist_ok=True)
+            # Only one process tokenizes; the others wait for it to publish the store. The kernel
+            # drops the lock if the builder dies, so a preempted build never blocks later runs
+            with open(f"{path}.lock", 'a') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    if not os.path.exists(path):
+                        print(f"🔄 Pre-tokenizing {len(questions)} prompts into {path}...")
+                        start = time.perf_counter()
+                        cls.build(path, questions, tokenizer, build_prompt, max_length)
+                        print(f"✓ Prompt store built in {time.perf_counter() - start:.1f}s")
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+
+        store = cls(path)
+        print(f"✓ Prompt store: {len(store)} prompts, {len(store.ids)} tokens ({path})")
+        return store
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Columnar results store for benchmark runs
+Results are kept as zstd-compressed Parquet, partitioned by run and model, with low-cardinality
+columns dictionary-encoded and question text stored once per dataset and referenced by
+question_id. Queries scan only the partitions and columns they need; CSV/JSON export on demand.
+
+Layout:
+    <root>/results/run_id=<run>/model=<model>/part-<n>.parquet
+    <root>/questions/<dataset fingerprint>.parquet
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from datetime import datetime
+from urllib.parse import quote
+
+from gemma3_saudi_benchmark import METRIC_COLUMNS
+
+DEFAULT_ROOT = "gemma3_results_store"
+
+PARTITION_COLUMNS = ['run_id', 'model']
+
+# Low-cardinality string columns, stored as dictionary indices
+DICTIONARY_COLUMNS = ['question_category', 'mode']
+
+def result_schema():
+    """Schema of every results file (the partition columns live in the directory names)"""
+    import pyarrow as pa
+
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    fields = [
+        ('question_id', pa.string()),
+        ('question_category', dictionary),
+        ('mode', dictionary),
+        ('sample_index', pa.int32()),
+        ('sample_seed', pa.int64()),
+        ('response', pa.string()),
+        ('response_chars', pa.int32()),  # Lets length queries skip the response text
+        ('timestamp', pa.timestamp('us')),
+        ('max_new_tokens', pa.int32()),
+    ]
+    fields += [(name, pa.int32() if name.endswith('_tokens') else pa.float64()) for name in METRIC_COLUMNS]
+    return pa.schema(fields)
+
+def question_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('question_id', pa.string()),
+        ('question_category', pa.dictionary(pa.int32(), pa.string())),
+        ('question', pa.string()),
+    ])
+
+def _partition_path(root, run_id, model):
+    # Model names like "unsloth/gemma-3-270m-it-GGUF" are URI-encoded into one path segment
+    return os.path.join(root, "results", f"run_id={quote(str(run_id), safe='')}", f"model={quote(str(model), safe='')}")
+
+def _column(rows, field):
+    """One schema column from a list of row dicts (NaN counts as missing)"""
+    import pyarrow as pa
+
+    values = [row.get(field.name) for row in rows]
+    if field.name == 'question_id':
+        values = [None if value is None else str(value) for value in values]
+    if field.name == 'response_chars':
+        values = [len(row['response']) if isinstance(row.get('response'), str) else None for row in rows]
+    if pa.types.is_dictionary(field.type):
+        return pa.array(values, pa.string(), from_pandas=True).dictionary_encode().cast(field.type)
+    if pa.types.is_timestamp(field.type):
+        # ISO strings from the CSV/JSONL stream, or datetimes (pd.read_json parses them)
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+        return pa.array(values, pa.string(), from_pandas=True).cast(field.type)
+    return pa.array(values, field.type, from_pandas=True)
+
+def _write_parquet(table, path):
+    """Write a table atomically"""
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    pq.write_table(table, tmp_path, compression="zstd", use_dictionary=DICTIONARY_COLUMNS)
+    os.replace(tmp_path, path)
+
+def write_questions(root, rows):
+    """Store the question text of these rows once per distinct dataset"""
+    import pyarrow as pa
+
+    questions = {}
+    for row in rows:
+        if row.get('question') is not None:
+            questions.setdefault(str(row['question_id']), (row.get('question_category'), row['question']))
+    if not questions:
+        return None
+
+    digest = hashlib.sha256(json.dumps(sorted(questions.items()), ensure_ascii=False).encode()).hexdigest()[:16]
+    path = os.path.join(root, "questions", f"{digest}.parquet")
+    if not os.path.exists(path):
+        ids = list(questions)
+        table = pa.table({
+            'question_id': ids,
+            'question_category': pa.array([questions[qid][0] for qid in ids], pa.string()).dictionary_encode(),
+            'question': [questions[qid][1] for qid in ids],
+        }).cast(question_schema())
+        _write_parquet(table, path)
+    return path
+
+def write_run(results, root=DEFAULT_ROOT, run_id=None, model=None, row_group_size=65536):
+    """Store one run's results (a DataFrame or a list of row dicts); returns the run_id
+
+    The model comes from the argument or the rows' 'model' column. Writing the same run_id
+    and model again adds another part to that partition.
+    """
+    import pyarrow as pa
+
+    rows = results.to_dict('records') if hasattr(results, 'to_dict') else list(results)
+    if not rows:
+        raise ValueError("No results to store")
+
+    run_id = run_id or datetime.now().strftime("%Y%m%dT%H%M%S")
+    write_questions(root, rows)
+
+    schema = result_schema()
+    by_model = {}
+    for row in rows:
+        by_model.setdefault(model or row.get('model') or "unknown", []).append(row)
+
+    for name, model_rows in by_model.items():
+        directory = _partition_path(root, run_id, name)
+        part = len([f for f in os.listdir(directory) if f.endswith(".parquet")]) if os.path.isdir(directory) else 0
+        table = pa.Table.from_arrays([_column(model_rows, field) for field in schema], schema=schema)
+        _write_parquet(table.combine_chunks(), os.path.join(directory, f"part-{part}.parquet"))
+        print(f"✓ Stored {len(model_rows)} results for run {run_id}, model {name}")
+
+    return run_id
+
+def open_results(root=DEFAULT_ROOT):
+    """The whole store as a pyarrow dataset (nothing is read until it is scanned)"""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([(name, pa.string()) for name in PARTITION_COLUMNS]), flavor="hive")
+    schema = pa.unify_schemas([result_schema(), partitioning.schema])
+    return ds.dataset(os.path.join(root, "results"), format="parquet", schema=schema, partitioning=partitioning)
+
+def _filter(runs=None, models=None, categories=None):
+    import pyarrow.dataset as ds
+
+    expression = None
+    for column, values in (('run_id', runs), ('model', models), ('question_category', categories)):
+        if values:
+            condition = ds.field(column).isin([str(value) for value in values])
+            expression = condition if expression is None else expression & condition
+    return expression
+
+def _aggregate(root, keys, aggregates, columns, runs=None, models=None, categories=None):
+    """Stream the matching partitions/columns through a grouped aggregation"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import acero
+
+    dataset = open_results(root)
+    expression = _filter(runs, models, categories)
+    nodes = [acero.Declaration("scan", acero.ScanNodeOptions(dataset, columns=columns, filter=expression))]
+    if expression is not None:
+        nodes.append(acero.Declaration("filter", acero.FilterNodeOptions(expression)))
+    # Each file has its own dictionary, and acero can't group across differing ones
+    projections = [pc.field(c).cast(pa.string()) if c in DICTIONARY_COLUMNS else pc.field(c) for c in columns]
+    nodes.append(acero.Declaration("project", acero.ProjectNodeOptions(projections, columns)))
+    nodes.append(acero.Declaration("aggregate", acero.AggregateNodeOptions(aggregates, keys=keys)))
+    return acero.Declaration.from_sequence(nodes).to_table()
+
+def list_runs(root=DEFAULT_ROOT):
+    """Rows stored per run and model"""
+    import pyarrow.compute as pc
+
+    table = _aggregate(root, PARTITION_COLUMNS, [
+        ('question_id', 'hash_count', pc.CountOptions(mode="all"), 'results'),
+        ('question_id', 'hash_count_distinct', None, 'questions'),
+        ('timestamp', 'hash_min', None, 'started'),
+        ('timestamp', 'hash_max', None, 'finished'),
+    ], ['run_id', 'model', 'question_id', 'timestamp'])
+    return table.to_pandas().sort_values(PARTITION_COLUMNS, ignore_index=True)
+
+def category_stats(root=DEFAULT_ROOT, runs=None, models=None, categories=None):
+    """Per run/model/category counts, response lengths and latency stats
+
+    Only the filtered partitions and the numeric columns are scanned, in a streaming
+    aggregation, so the cost doesn't grow with the other runs in the store.
+    """
+    import pyarrow.compute as pc
+
+    quantiles = pc.TDigestOptions(q=[0.5, 0.95])
+    keys = PARTITION_COLUMNS + ['question_category']
+    table = _aggregate(root, keys, [
+        ('question_id', 'hash_count', pc.CountOptions(mode="all"), 'results'),
+        ('response_chars', 'hash_mean', None, 'chars_mean'),
+        ('response_chars', 'hash_max', None, 'chars_max'),
+        ('generated_tokens', 'hash_mean', None, 'tokens_mean'),
+        ('total_s', 'hash_tdigest', quantiles, 'latency'),
+        ('ttft_s', 'hash_tdigest', quantiles, 'ttft'),
+        ('decode_tokens_per_s', 'hash_mean', None, 'decode_tokens_per_s'),
+    ], keys + ['question_id', 'response_chars', 'generated_tokens', 'total_s', 'ttft_s', 'decode_tokens_per_s'],
+        runs, models, categories)
+
+    df = table.to_pandas()
+    # Approximate (t-digest) percentiles, NaN where a run has no timings
+    for name in ('latency', 'ttft'):
+        df[f"{name}_p50_s"] = df[name].map(lambda q: q[0])
+        df[f"{name}_p95_s"] = df[name].map(lambda q: q[1])
+    df = df.drop(columns=['latency', 'ttft'])
+    df['question_category'] = df['question_category'].astype(str)
+    return df.sort_values(keys, ignore_index=True)
+
+def read_questions(root=DEFAULT_ROOT):
+    """question_id -> question text table, one row per id"""
+    import pyarrow.dataset as ds
+
+    directory = os.path.join(root, "questions")
+    if not os.path.isdir(directory):
+        return question_schema().empty_table().drop_columns(['question_category'])
+    table = ds.dataset(directory, format="parquet", schema=question_schema()).to_table(columns=['question_id', 'question'])
+    return table.group_by('question_id', use_threads=False).aggregate([('question', 'first')]).rename_columns(
+        ['question_id', 'question'])
+
+def iter_results(root=DEFAULT_ROOT, runs=None, models=None, categories=None, with_questions=True, batch_size=65536):
+    """Yield the matching results as row dicts, with question text joined back in"""
+    import pyarrow as pa
+
+    questions = read_questions(root) if with_questions else None
+    dataset = open_results(root)
+    for batch in dataset.to_batches(filter=_filter(runs, models, categories), batch_size=batch_size):
+        table = pa.Table.from_batches([batch])
+        # Plain strings for joins and export
+        for name in DICTIONARY_COLUMNS:
+            table = table.set_column(table.schema.get_field_index(name), name, table[name].cast(pa.string()))
+        if questions is not None:
+            table = table.join(questions, 'question_id', join_type='left outer')
+        yield from table.to_pylist()
+
+def export_results(path, root=DEFAULT_ROOT, runs=None, models=None, categories=None):
+    """Write the matching results with their question text to a .csv or .json file"""
+    import csv
+
+    columns = (['question_id', 'question_category', 'question', 'response', 'timestamp', 'model', 'run_id', 'mode']
+               + [name for name in result_schema().names if name not in ('question_id', 'question_category',
+                                                                          'response', 'timestamp', 'mode')])
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        as_json = path.endswith(".json")
+        if as_json:
+            f.write("[")
+        else:
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+
+        for row in iter_results(root, runs, models, categories):
+            if row.get('timestamp') is not None:
+                row['timestamp'] = row['timestamp'].isoformat()
+            if as_json:
+                record = {column: row.get(column) for column in columns if row.get(column) is not None}
+                f.write(("\n  " if count == 0 else ",\n  ") + json.dumps(record, ensure_ascii=False))
+            else:
+                writer.writerow(row)
+            count += 1
+
+        if as_json:
+            f.write("\n]\n")
+
+    print(f"✓ Exported {count} results to {path}")
+    return count
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Columnar results store for benchmark runs")
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="Store directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="Import a results .csv/.json/.jsonl file as a run")
+    add.add_argument("path")
+    add.add_argument("--run-id", default=None, help="Run name (default: current time)")
+    add.add_argument("--model", default=None, help="Model name (default: the file's model column)")
+
+    commands.add_parser("runs", help="List stored runs")
+
+    for name, description in (("stats", "Per-category counts, lengths and latency"),
+                              ("export", "Write results with question text to .csv or .json")):
+        command = commands.add_parser(name, help=description)
+        if name == "export":
+            command.add_argument("path")
+        command.add_argument("--run", action="append", default=None, help="Run id (repeatable)")
+        command.add_argument("--model", action="append", default=None, help="Model (repeatable)")
+        command.add_argument("--category", action="append", default=None, help="Question category (repeatable)")
+
+    args = parser.parse_args()
+
+    if args.command == "add":
+        import pandas as pd
+        if args.path.endswith(".jsonl"):
+            results = pd.read_json(args.path, lines=True, dtype={'question_id': str})
+        elif args.path.endswith(".json"):
+            results = pd.read_json(args.path, dtype={'question_id': str})
+        else:
+            results = pd.read_csv(args.path, dtype={'question_id': str})
+        write_run(results, args.root, args.run_id, args.model)
+    elif args.command == "runs":
+        print(list_runs(args.root).to_string(index=False))
+    elif args.command == "stats":
+        stats = category_stats(args.root, args.run, args.model, args.category)
+        print(stats.round(2).to_string(index=False))
+    else:
+        export_results(args.path, args.root, args.run, args.model, args.category)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,26 +4,24 @@ Demo benchmark runner that generates realistic mock responses
 This demonstrates the exact workflow and output format without requiring ML dependencies
 """
 
+import argparse
 import csv
 import json
 from datetime import datetime
 import os
+import random
+import time
 
-def load_benchmark_questions():
+from importlib.util import find_spec
+
+from benchmark_data import iter_question_records
+
+DEMO_MODEL = 'unsloth/gemma-3-270m-it-GGUF'
+
+def load_benchmark_questions(categories=None):
     """Load questions from the benchmark CSV"""
     csv_path = "Pico-Saudi-LLMs-Benchmark/v0.01/Pico-Saudi-LLMs-Questions-v0.01.csv"
-    
-    questions = []
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            questions.append({
-                'question_id': row['question_id'],
-                'question_category': row['question_category'],
-                'question': row['question']
-            })
-    
-    return questions
+    return list(iter_question_records(csv_path, categories=categories))
 
 def generate_realistic_arabic_response(question, category):
     """Generate realistic Arabic responses based on question category"""
@@ -84,8 +82,94 @@ def generate_realistic_arabic_response(question, category):
     response_index = hash(question) % len(category_responses)
     return category_responses[response_index]
 
-def run_benchmark():
-    """Run the benchmark and generate responses"""
+class MockBackend:
+    """Model-free generation backend for gemma3_saudi_benchmark.run_benchmark
+    
+    Answers with generate_realistic_arabic_response, truncated to max_new_tokens words, and
+    sleeps to simulate a model:
+    prefill_latency per prompt token, plus token_latency per decode step (one step
+    produces a token for every question in the batch).
+    """
+    
+    def __init__(self, token_latency=0.0, prefill_latency=0.0):
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+    
+    def identity(self):
+        return {'name': 'mock', 'token_latency': self.token_latency, 'prefill_latency': self.prefill_latency}
+    
+    def prompt(self, question):
+        return question['question']
+    
+    def prompt_lengths(self, questions):
+        # Word count stands in for tokenized length
+        return [len(q['question'].split()) for q in questions]
+    
+    def bucket(self, questions, batch_size):
+        from gemma3_saudi_benchmark import bucket_by_length
+        return bucket_by_length(self.prompt_lengths(questions), batch_size)
+    
+    def seed(self, seed):
+        random.seed(seed)
+    
+    def generate_one(self, question):
+        responses, metrics = self.generate_batch([question])
+        return responses[0], metrics[0]
+    
+    def generate_samples(self, question, seeds):
+        # One prefill, then one decode step per token for all samples together
+        responses, metrics = self.generate_batch([question] * len(seeds), prefill_rows=1)
+        responses = [random.Random(seed).choice(responses + [response + "."]) for seed, response in zip(seeds, responses)]
+        return responses, metrics
+    
+    def generate_batch(self, questions, prefill_rows=None):
+        from gemma3_saudi_benchmark import GENERATION_KWARGS
+        
+        start = time.perf_counter()
+        # Word count stands in for generated tokens, cut off at the current budget like generate does
+        max_new_tokens = GENERATION_KWARGS['max_new_tokens']
+        responses = [generate_realistic_arabic_response(q['question'], q['question_category']) for q in questions]
+        responses = [response if len(response.split()) <= max_new_tokens
+                     else " ".join(response.split()[:max_new_tokens]) for response in responses]
+        prompt_tokens = [len(q['question'].split()) for q in questions]
+        generated_tokens = [len(response.split()) for response in responses]
+        
+        # Prefill covers the padded batch, decode runs until the longest answer is done
+        time.sleep(self.prefill_latency * max(prompt_tokens) * (prefill_rows or len(questions)))
+        first_token = time.perf_counter()
+        time.sleep(self.token_latency * max(generated_tokens))
+        end = time.perf_counter()
+        
+        metrics = [{
+            'prompt_tokens': prompt,
+            'generated_tokens': generated,
+            'prefill_s': first_token - start,
+            'ttft_s': first_token - start,
+            'decode_tokens_per_s': generated / (end - first_token) if end > first_token else None,
+            'total_s': end - start,
+            'peak_rss_mb': None,
+        } for prompt, generated in zip(prompt_tokens, generated_tokens)]
+        return responses, metrics
+
+def write_results_files(results, paths):
+    """Write the results to .csv/.json files directly (used when pyarrow isn't installed)"""
+    for path in paths:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            if path.endswith(".json"):
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            else:
+                fieldnames = ['question_id', 'question_category', 'question', 'response', 'timestamp', 'model', 'mode']
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(results)
+        print(f"✓ Results saved to {path}")
+
+def run_benchmark(store_root="gemma3_results_store", exports=()):
+    """Run the benchmark and generate responses
+    
+    Results go to the columnar results store (see results_store.py); exports lists .csv/.json
+    files to write from it as well.
+    """
     print("🚀 Gemma-3 270M GGUF Saudi LLMs Benchmark Runner")
     print("=" * 50)
     print("📋 Demo Mode: Generating realistic mock responses")
@@ -113,7 +197,7 @@ def run_benchmark():
             'question': q['question'],
             'response': response,
             'timestamp': datetime.now().isoformat(),
-            'model': 'unsloth/gemma-3-270m-it-GGUF',
+            'model': DEMO_MODEL,
             'mode': 'demo_simulation'
         }
         results.append(result)
@@ -122,22 +206,19 @@ def run_benchmark():
         if (i + 1) % 10 == 0:
             print(f"✓ Completed {i + 1} questions")
     
-    # Save results to CSV
-    output_file = "gemma3_results_demo.csv"
-    with open(output_file, 'w', newline='', encoding='utf-8') as f:
-        fieldnames = ['question_id', 'question_category', 'question', 'response', 'timestamp', 'model', 'mode']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
-    
-    print(f"\n✓ Results saved to {output_file}")
-    
-    # Also save as JSON for easier reading
-    json_file = "gemma3_results_demo.json"
-    with open(json_file, 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
-    
-    print(f"✓ Results also saved to {json_file}")
+    print()
+    if find_spec("pyarrow") is not None:
+        from results_store import export_results, write_run
+        
+        run_id = write_run(results, store_root, model=DEMO_MODEL)
+        for path in exports:
+            export_results(path, store_root, runs=[run_id])
+        saved_to = f"{store_root} (run {run_id})"
+    else:
+        # Without pyarrow there is no store, so write plain files (the CSV by default)
+        exports = list(exports) or ["gemma3_results_demo.csv"]
+        write_results_files(results, exports)
+        saved_to = " and ".join(exports)
     
     # Display statistics
     print("\n📊 Benchmark Statistics:")
@@ -159,9 +240,14 @@ def run_benchmark():
     print("\n" + "=" * 50)
     print("✅ Demo benchmark completed successfully!")
     print(f"📊 Processed {len(results)} questions")
-    print(f"📁 Results saved to {output_file} and {json_file}")
+    print(f"📁 Results saved to {saved_to}")
     print("\n💡 Note: This is a demo with simulated responses.")
     print("   In the real script, these would be generated by the Gemma-3 270M GGUF model.")
 
 if __name__ == "__main__":
-    run_benchmark()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Demo benchmark runner with simulated responses")
+    parser.add_argument("--store", default="gemma3_results_store", help="Results store directory")
+    parser.add_argument("--export", action="append", default=[],
+                        help="Also write the run to this .csv or .json file (repeatable)")
+    args = parser.parse_args()
+    run_benchmark(args.store, args.export)
\ No newline at end of file
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Scoring stage for benchmark results
+Streams over a results file (or a run in the results store) in chunks and scores every response:
+Arabic-script ratio, Latin and code leakage, length and truncation are computed with NumPy over
+the codepoints of the whole chunk at once; numeric reasoning answers are checked against an
+answer key; coding answers are executed in isolated subprocesses with time and memory limits.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_ANSWER_KEY = "benchmark_answer_key.csv"
+
+# Codepoint classes
+OTHER, ARABIC, LATIN, DIGIT, CODE, SPACE = range(6)
+CLASS_NAMES = ['other', 'arabic', 'latin', 'digit', 'code', 'space']
+
+ARABIC_RANGES = [(0x0600, 0x06FF), (0x0750, 0x077F), (0x08A0, 0x08FF), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF)]
+LATIN_RANGES = [(ord('A'), ord('Z')), (ord('a'), ord('z')), (0x00C0, 0x024F)]
+DIGIT_RANGES = [(ord('0'), ord('9')), (0x0660, 0x0669), (0x06F0, 0x06F9)]
+CODE_SYMBOLS = "{}[]()<>=;_#$%&*+/\\|^~`\"'"
+
+# Arabic-Indic and extended (Persian) digits, Arabic decimal and thousands separators
+DIGIT_TRANSLATION = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹٫٬", "01234567890123456789.,")
+NUMBER_PATTERN = r"-?\d+(?:\.\d+)?"
+CODE_BLOCK_PATTERN = re.compile(r"```[ \t]*([\w+#-]*)[^\n]*\n(.*?)```", re.DOTALL)
+PYTHON_TAGS = {"", "python", "py", "python3"}
+
+# Runs the answer in a fresh isolated interpreter with memory and CPU limits
+SANDBOX_LAUNCHER = """
+import runpy, sys
+try:
+    import resource
+    memory = int(sys.argv[2]) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_CPU, (int(sys.argv[3]), int(sys.argv[3])))
+except (ImportError, ValueError, OSError):
+    pass
+sys.argv = [sys.argv[1]]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+def build_class_table():
+    """Class of every Unicode codepoint, indexed by codepoint"""
+    table = np.full(0x110000, OTHER, dtype=np.uint8)
+    for ranges, cls in ((ARABIC_RANGES, ARABIC), (LATIN_RANGES, LATIN), (DIGIT_RANGES, DIGIT)):
+        for low, high in ranges:
+            table[low:high + 1] = cls
+    # Arabic punctuation is not Arabic text, and × ÷ are not Latin letters
+    for char in "،؛؟٪٫٬٭۔×÷":
+        table[ord(char)] = OTHER
+    for char in CODE_SYMBOLS:
+        table[ord(char)] = CODE
+    for char in " \t\n\r\f\v ":
+        table[ord(char)] = SPACE
+    return table
+
+CLASS_TABLE = build_class_table()
+
+def codepoint_counts(texts):
+    """[rows, classes] counts of each codepoint class per text, in one pass over the whole chunk"""
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    codepoints = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+    classes = CLASS_TABLE[codepoints]
+    rows = np.repeat(np.arange(len(texts)), lengths)
+    counts = np.bincount(rows * len(CLASS_NAMES) + classes, minlength=len(texts) * len(CLASS_NAMES))
+    return counts.reshape(len(texts), len(CLASS_NAMES)), lengths
+
+def text_scores(responses, generated_tokens=None, max_new_tokens=None):
+    """Language, length and truncation scores for a chunk of responses"""
+    import pandas as pd
+
+    texts = ["" if not isinstance(text, str) else text for text in responses]
+    counts, lengths = codepoint_counts(texts)
+    letters = counts[:, ARABIC] + counts[:, LATIN]
+    visible = lengths - counts[:, SPACE]
+    backticks = np.fromiter((text.count("```") for text in texts), dtype=np.int64, count=len(texts))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = pd.DataFrame({
+            'response_chars': lengths,
+            'arabic_ratio': np.where(letters > 0, counts[:, ARABIC] / letters, np.nan),
+            'latin_ratio': np.where(letters > 0, counts[:, LATIN] / letters, np.nan),
+            'code_symbol_ratio': np.where(visible > 0, counts[:, CODE] / visible, np.nan),
+            'has_code_block': backticks >= 2,
+        })
+
+    if generated_tokens is not None and max_new_tokens is not None:
+        tokens = pd.to_numeric(pd.Series(generated_tokens), errors="coerce").to_numpy(dtype=float)
+        # One budget for the whole chunk, or one per row
+        limits = pd.to_numeric(pd.Series(np.broadcast_to(max_new_tokens, len(texts))), errors="coerce").to_numpy(dtype=float)
+        # Unknown (e.g. cached) token counts stay unknown
+        known = ~np.isnan(tokens) & ~np.isnan(limits)
+        scores['truncated'] = pd.array(np.where(known, tokens >= limits, None), dtype="boolean")
+    else:
+        scores['truncated'] = pd.array([None] * len(texts), dtype="boolean")
+    return scores
+
+def load_answer_key(path):
+    """question_id -> {'answer', 'tolerance', 'test', 'stdin', 'stdout'} from a CSV answer key"""
+    import pandas as pd
+
+    if not path or not os.path.exists(path):
+        return {}
+    key = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return {row['question_id']: row for row in key.to_dict('records')}
+
+def check_numeric_answers(responses, expected, tolerance):
+    """Whether the last number in each response matches its expected value (NaN where there's no key)"""
+    import pandas as pd
+
+    expected = pd.to_numeric(pd.Series(expected), errors="coerce").to_numpy()
+    tolerance = pd.to_numeric(pd.Series(tolerance), errors="coerce").fillna(1e-6).to_numpy()
+
+    # Only responses with a key are parsed
+    keyed = ~np.isnan(expected)
+    last = np.full(len(expected), np.nan)
+    if keyed.any():
+        normalized = pd.Series(responses, dtype="object")[keyed].fillna("").str.translate(DIGIT_TRANSLATION)
+        # "1,000" is one number; "2, 3" stays two
+        normalized = normalized.str.replace(r"(?<=\d),(?=\d{3}\b)", "", regex=True)
+        last[keyed] = pd.to_numeric(normalized.str.findall(NUMBER_PATTERN).str[-1], errors="coerce").to_numpy()
+
+    correct = np.abs(last - expected) <= np.maximum(tolerance, tolerance * np.abs(expected))
+    correct = np.where(np.isnan(last), False, correct)
+    return pd.array(np.where(np.isnan(expected), None, correct), dtype="boolean")
+
+def extract_python(response):
+    """The Python code in a response: its Python code blocks, or the whole response if it compiles"""
+    if not isinstance(response, str):
+        return None, "no_code"
+    blocks = CODE_BLOCK_PATTERN.findall(response)
+    if blocks:
+        code = "\n\n".join(body for tag, body in blocks if tag.lower() in PYTHON_TAGS)
+        return (code, None) if code.strip() else (None, "not_python")
+    try:
+        compile(response, "<response>", "exec")
+    except (SyntaxError, ValueError):
+        return None, "no_code"
+    return response, None
+
+def run_sandboxed(code, test="", stdin="", timeout=5.0, memory_mb=512, stdout=""):
+    """Run an answer (plus its tests) in a fresh interpreter in an empty directory; returns (status, detail)
+
+    An answer passes when it exits cleanly and its tests (if any) pass and its output matches
+    stdout (if given); with neither to check against, a clean exit is only reported as "ran".
+    The limits guard against runaway answers, not against hostile code: the process still
+    runs as this user and can reach the network.
+    """
+    with tempfile.TemporaryDirectory(prefix="score_") as workdir:
+        path = os.path.join(workdir, "answer.py")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(code + ("\n\n" + test if test else "") + "\n")
+        command = [sys.executable, "-I", "-c", SANDBOX_LAUNCHER, path, str(memory_mb), str(int(timeout) + 1)]
+        try:
+            process = subprocess.run(command, cwd=workdir, input=stdin or "", capture_output=True, text=True,
+                                     timeout=timeout, env={"PATH": os.environ.get("PATH", ""), "HOME": workdir})
+        except subprocess.TimeoutExpired:
+            return "timeout", f"killed after {timeout}s"
+    if process.returncode != 0:
+        lines = process.stderr.strip().splitlines()
+        return "failed", lines[-1] if lines else f"exit code {process.returncode}"
+    if stdout and process.stdout.split() != str(stdout).split():
+        return "failed", f"expected output {str(stdout).strip()!r}, got {process.stdout.strip()[-200:]!r}"
+    if not test and not stdout:
+        return "ran", ""
+    return "passed", ""
+
+def iter_result_chunks(path=None, chunksize=50000, store=None, runs=None):
+    """Yield the results as DataFrame chunks from a .csv/.jsonl/.json file or the results store"""
+    import pandas as pd
+
+    if store is not None:
+        from results_store import iter_results
+        chunk = []
+        for row in iter_results(store, runs=runs, with_questions=False, batch_size=chunksize):
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk)
+    elif path.endswith(".jsonl"):
+        yield from pd.read_json(path, lines=True, chunksize=chunksize, dtype={'question_id': str})
+    elif path.endswith(".json"):
+        yield pd.read_json(path, dtype={'question_id': str})
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize, dtype={'question_id': str})
+
+def score_chunk(chunk, answer_key, pool, max_new_tokens, timeout=5.0, memory_mb=512):
+    """Score one chunk of results; coding answers run on the pool while the rest is vectorized"""
+    responses = chunk['response'].tolist()
+    categories = chunk['question_category'].astype(str).to_numpy()
+    question_ids = chunk['question_id'].astype(str).tolist()
+
+    # Start the slow part first
+    jobs = {}
+    code_status = [None] * len(chunk)
+    for i in np.flatnonzero(categories == "coding"):
+        code, status = extract_python(responses[i])
+        if code is None:
+            code_status[i] = status
+            continue
+        entry = answer_key.get(question_ids[i], {})
+        jobs[i] = pool.submit(run_sandboxed, code, entry.get('test', ""), entry.get('stdin', ""), timeout, memory_mb,
+                              entry.get('stdout', ""))
+
+    generated = chunk['generated_tokens'] if 'generated_tokens' in chunk.columns else None
+    if 'max_new_tokens' in chunk.columns:  # Serving mode and token-budget runs record each row's own budget
+        max_new_tokens = chunk['max_new_tokens'].fillna(max_new_tokens).to_numpy()
+    scores = text_scores(responses, generated, max_new_tokens)
+
+    keys = [answer_key.get(qid, {}) for qid in question_ids]
+    scores['answer_correct'] = check_numeric_answers(responses, [entry.get('answer') for entry in keys],
+                                                     [entry.get('tolerance') for entry in keys])
+
+    code_detail = [None] * len(chunk)
+    for i, job in jobs.items():
+        code_status[i], code_detail[i] = job.result()
+    scores['code_status'] = code_status
+    scores['code_error'] = code_detail
+
+    ids = ['question_id', 'question_category'] + [c for c in ('sample_index', 'model', 'run_id') if c in chunk.columns]
+    return chunk[ids].reset_index(drop=True).join(scores)
+
+class ScoreSummary:
+    """Per-category totals accumulated chunk by chunk"""
+
+    def __init__(self, arabic_threshold=0.8):
+        self.arabic_threshold = arabic_threshold
+        self.totals = None
+
+    def add(self, scores):
+        frame = scores.assign(
+            responses=1,
+            # Responses without any letters have no ratios
+            with_letters=scores['arabic_ratio'].notna(),
+            arabic_compliant=scores['arabic_ratio'] >= self.arabic_threshold,
+            with_tokens=scores['truncated'].notna(),
+            truncated=scores['truncated'].fillna(False).astype(bool),
+            answers_checked=scores['answer_correct'].notna(),
+            answers_correct=scores['answer_correct'].fillna(False).astype(bool),
+            # Answers that only "ran" had nothing to check against
+            code_run=scores['code_status'].isin(["passed", "failed", "timeout"]),
+            code_passed=scores['code_status'] == "passed",
+        )
+        columns = ['responses', 'with_letters', 'arabic_ratio', 'arabic_compliant', 'latin_ratio', 'response_chars',
+                   'with_tokens', 'truncated', 'answers_checked', 'answers_correct', 'code_run', 'code_passed']
+        totals = frame.groupby('question_category')[columns].sum()
+        self.totals = totals if self.totals is None else self.totals.add(totals, fill_value=0)
+
+    def table(self):
+        totals = self.totals
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return totals.assign(
+                arabic_ratio=totals['arabic_ratio'] / totals['with_letters'],
+                arabic_compliant=totals['arabic_compliant'] / totals['with_letters'],
+                latin_ratio=totals['latin_ratio'] / totals['with_letters'],
+                mean_chars=totals['response_chars'] / totals['responses'],
+                truncated=totals['truncated'] / totals['with_tokens'],
+                answer_accuracy=totals['answers_correct'] / totals['answers_checked'],
+                code_pass_rate=totals['code_passed'] / totals['code_run'],
+            )[['responses', 'arabic_ratio', 'arabic_compliant', 'latin_ratio', 'mean_chars', 'truncated',
+               'answer_accuracy', 'code_pass_rate']]
+
+def score_results(path=None, output_file=None, answer_key_path=DEFAULT_ANSWER_KEY, max_new_tokens=None,
+                  workers=None, timeout=5.0, memory_mb=512, chunksize=50000, store=None, runs=None,
+                  arabic_threshold=0.8):
+    """Score every response in a results file (or results store run) and stream the scores to output_file"""
+    if max_new_tokens is None:
+        from gemma3_saudi_benchmark import GENERATION_KWARGS
+        max_new_tokens = GENERATION_KWARGS['max_new_tokens']
+
+    answer_key = load_answer_key(answer_key_path)
+    print(f"📋 Answer key: {len(answer_key)} questions" if answer_key else "📋 No answer key, answers are not checked")
+
+    summary = ScoreSummary(arabic_threshold)
+    start = time.perf_counter()
+    scored = 0
+    # Each job blocks on its own subprocess, so threads are enough to keep that many sandboxes busy
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for i, chunk in enumerate(iter_result_chunks(path, chunksize, store, runs)):
+            scores = score_chunk(chunk, answer_key, pool, max_new_tokens, timeout, memory_mb)
+            scores.to_csv(output_file, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            summary.add(scores)
+            scored += len(scores)
+            print(f"✓ Scored {scored} responses ({scored / (time.perf_counter() - start):.0f}/sec)")
+
+    if summary.totals is None:
+        print("⚠️  No results to score")
+        return None
+    print(f"✓ Scores saved to {output_file}")
+    return summary.table()
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Score benchmark responses for Arabic compliance and correctness")
+    parser.add_argument("input", nargs="?", default="gemma3_results.csv",
+                        help="Results file (.csv, .jsonl or .json)")
+    parser.add_argument("--store", default=None, help="Score runs from this results store instead of a file")
+    parser.add_argument("--run", action="append", default=None, help="Run id in the results store (repeatable)")
+    parser.add_argument("--output", default=None, help="Scores CSV (default: <input>_scores.csv)")
+    parser.add_argument("--answer-key", default=DEFAULT_ANSWER_KEY,
+                        help="CSV with question_id, answer, tolerance, test, stdin and stdout columns")
+    parser.add_argument("--max-new-tokens", type=int, default=None,
+                        help="Generation budget of the run, for the truncation flag (default: the runner's)")
+    parser.add_argument("--arabic-threshold", type=float, default=0.8,
+                        help="Arabic share of letters a response needs to count as compliant")
+    parser.add_argument("--workers", type=int, default=None, help="Code answers executed at once (default: cores)")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Seconds each code answer may run")
+    parser.add_argument("--memory-mb", type=int, default=512, help="Memory limit of each code answer")
+    parser.add_argument("--chunksize", type=int, default=50000, help="Responses scored per chunk")
+    args = parser.parse_args()
+
+    print("🚀 Gemma-3 Saudi LLMs Benchmark Scoring")
+    print("=" * 50)
+
+    if args.store is None and not os.path.exists(args.input):
+        print(f"❌ Could not find results file: {args.input}")
+        return 1
+    output_file = args.output or (os.path.splitext(args.input if args.store is None else "store")[0] + "_scores.csv")
+
+    summary = score_results(args.input, output_file, args.answer_key, args.max_new_tokens, args.workers,
+                            args.timeout, args.memory_mb, args.chunksize, args.store, args.run,
+                            args.arabic_threshold)
+    if summary is None:
+        return 1
+
+    print("=" * 50)
+    print(summary.round(3).to_string())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
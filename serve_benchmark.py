@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+Long-running serving mode for the Gemma-3 benchmark model
+Keeps one model loaded and answers JSONL requests from a file, stdin or a local socket,
+admitting new requests into the running decode batch as soon as a slot frees up
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import gemma3_saudi_benchmark as bench
+
+def resize_cache(cache, old_length, new_length):
+    """Add zero columns to (or drop columns from) the left of a KV cache so it spans new_length positions"""
+    import torch
+
+    for layer in cache.layers:
+        if not layer.is_initialized:
+            continue
+        # Sliding window layers only hold the last window - 1 positions
+        window = layer.sliding_window - 1 if getattr(layer, "is_sliding", False) else None
+        keys, values = layer.keys, layer.values
+        if new_length < old_length:
+            keep = min(keys.shape[-2], new_length)
+            keys, values = keys[:, :, keys.shape[-2] - keep:], values[:, :, values.shape[-2] - keep:]
+        elif new_length > old_length:
+            shape = list(keys.shape)
+            shape[-2] = new_length - old_length
+            keys = torch.cat([keys.new_zeros(shape), keys], dim=-2)
+            values = torch.cat([values.new_zeros(shape), values], dim=-2)
+        if window is not None:
+            keys, values = keys[:, :, -window:], values[:, :, -window:]
+        layer.keys, layer.values = keys, values
+        if hasattr(layer, "cumulative_length"):
+            layer.cumulative_length = new_length
+
+def concat_caches(cache, other):
+    """Append the rows of other to cache (both must span the same positions)"""
+    import torch
+
+    for layer, extra in zip(cache.layers, other.layers):
+        layer.keys = torch.cat([layer.keys, extra.keys], dim=0)
+        layer.values = torch.cat([layer.values, extra.values], dim=0)
+
+class ServeRequest:
+    """One request in flight: its prompt, generated tokens and timings"""
+
+    def __init__(self, record, max_new_tokens, future=None):
+        self.record = record
+        self.max_new_tokens = max_new_tokens
+        self.future = future
+        self.tokens = []
+        self.prompt_tokens = 0
+        self.arrived = time.perf_counter()
+        self.admitted = None
+        self.first_token = None
+        self.finished = None
+        self.error = None
+
+    def result(self, tokenizer):
+        """The JSONL result row for a finished request"""
+        end = self.finished or time.perf_counter()
+        generated = len(self.tokens)
+        decode_time = end - self.first_token if self.first_token is not None else 0.0
+        if self.error is not None:
+            response = f"Error: {self.error}"
+        else:
+            response = bench.truncate_at_stop(tokenizer.decode(self.tokens, skip_special_tokens=True)).strip()
+        return {
+            **self.record,
+            'response': response,
+            'max_new_tokens': self.max_new_tokens,
+            'timestamp': datetime.now().isoformat(),
+            'prompt_tokens': self.prompt_tokens,
+            'generated_tokens': generated,
+            'queue_s': (self.admitted or end) - self.arrived,
+            'prefill_s': (self.first_token or end) - (self.admitted or end),
+            'ttft_s': (self.first_token or end) - self.arrived,
+            'decode_tokens_per_s': (generated - 1) / decode_time if generated > 1 and decode_time > 0 else None,
+            'total_s': end - self.arrived,
+        }
+
+class ContinuousBatcher:
+    """Decodes a batch of requests one token at a time, admitting and retiring rows between steps
+
+    Every row of the batched KV cache is left-padded to the same number of positions. A new
+    request is prefilled on its own and then merged in; a finished request is dropped at once,
+    so short requests never wait for long ones. Sampling follows GENERATION_KWARGS
+    (repetition_penalty is not applied).
+    """
+
+    def __init__(self, model, tokenizer, system_prompt=None, max_batch_size=8, max_length=1024):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.system_prompt = system_prompt
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+        self.device = getattr(model, "device", "cpu")
+        self.stop_ids = set(bench.stop_token_ids(tokenizer))
+        self.active = []
+        self.cache = None
+        self.attention_mask = None  # [rows, positions]
+        self.positions = None       # next position id of every row
+        self.next_tokens = None     # last sampled token of every row, not yet fed to the model
+
+    def free_slots(self):
+        return self.max_batch_size - len(self.active)
+
+    def done(self, request):
+        """Record the latest token's effect; True once the request should stop"""
+        if request.first_token is None:
+            request.first_token = time.perf_counter()
+        if (request.tokens[-1] in self.stop_ids or len(request.tokens) >= request.max_new_tokens
+                or self.hit_stop_string(request)):
+            request.finished = time.perf_counter()
+            return True
+        return False
+
+    def hit_stop_string(self, request):
+        """Whether the text generated so far contains a stop string"""
+        if not bench.STOP_STRINGS:
+            return False
+        text = self.tokenizer.decode(request.tokens, skip_special_tokens=True)
+        return any(stop in text for stop in bench.STOP_STRINGS)
+
+    def admit(self, request):
+        """Prefill a request and merge it into the running batch; returns it if it already finished"""
+        import torch
+
+        request.admitted = time.perf_counter()
+        prompt = bench.build_prompt(request.record['question'], self.system_prompt)
+        input_ids = self.tokenizer(prompt, return_tensors="pt", truncation=True,
+                                   max_length=self.max_length)["input_ids"].to(self.device)
+        request.prompt_tokens = input_ids.shape[1]
+
+        with torch.no_grad():
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        token = bench.pick_next_tokens(outputs.logits[:, -1])
+        request.tokens.append(int(token[0]))
+        if self.done(request):
+            return request
+
+        length = input_ids.shape[1]
+        mask = torch.ones(1, length, dtype=torch.long, device=self.device)
+        if self.cache is None:
+            self.cache, self.attention_mask = outputs.past_key_values, mask
+            self.positions = torch.tensor([length], device=self.device)
+            self.next_tokens = token
+        else:
+            width = self.attention_mask.shape[1]
+            target = max(width, length)
+            resize_cache(self.cache, width, target)
+            resize_cache(outputs.past_key_values, length, target)
+            concat_caches(self.cache, outputs.past_key_values)
+            self.attention_mask = torch.cat([
+                torch.nn.functional.pad(self.attention_mask, (target - width, 0)),
+                torch.nn.functional.pad(mask, (target - length, 0)),
+            ])
+            self.positions = torch.cat([self.positions, torch.tensor([length], device=self.device)])
+            self.next_tokens = torch.cat([self.next_tokens, token])
+        self.active.append(request)
+        return None
+
+    def step(self):
+        """Generate one token for every active row; returns the requests that finished"""
+        import torch
+
+        if not self.active:
+            return []
+
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones(len(self.active), 1)], dim=1)
+        with torch.no_grad():
+            outputs = self.model(input_ids=self.next_tokens[:, None], attention_mask=self.attention_mask,
+                                 position_ids=self.positions[:, None], past_key_values=self.cache, use_cache=True)
+        self.cache = outputs.past_key_values
+        self.positions = self.positions + 1
+        self.next_tokens = bench.pick_next_tokens(outputs.logits[:, -1])
+
+        finished = []
+        for request, token in zip(self.active, self.next_tokens.tolist()):
+            request.tokens.append(token)
+            if self.done(request):
+                finished.append(request)
+        if finished:
+            self.retire(finished)
+        return finished
+
+    def retire(self, finished):
+        """Drop finished rows and any padding columns no remaining row needs"""
+        import torch
+
+        keep = [i for i, request in enumerate(self.active) if request not in finished]
+        self.active = [self.active[i] for i in keep]
+        if not self.active:
+            self.cache = self.attention_mask = self.positions = self.next_tokens = None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self.cache.batch_select_indices(index)
+        self.attention_mask = self.attention_mask[index]
+        self.positions = self.positions[index]
+        self.next_tokens = self.next_tokens[index]
+
+        unused = int(self.attention_mask.any(dim=0).long().argmax())
+        if unused:
+            width = self.attention_mask.shape[1]
+            resize_cache(self.cache, width, width - unused)
+            self.attention_mask = self.attention_mask[:, unused:]
+
+    def run(self, requests):
+        """Admit requests, then run one decode step; returns every request that finished"""
+        finished = [request for request in map(self.admit, requests) if request is not None]
+        return finished + self.step()
+
+    def abort(self, error):
+        """Fail every active request (e.g. after running out of memory) and start over empty"""
+        failed = self.active
+        for request in failed:
+            request.error = error
+            request.finished = time.perf_counter()
+        self.active = []
+        self.cache = self.attention_mask = self.positions = self.next_tokens = None
+        return failed
+
+def parse_request(line, default_max_new_tokens):
+    """Turn one JSONL line into a request record and its max_new_tokens"""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("each line must be a JSON object")
+    question = record.get('question') or record.get('prompt') or record.get('body')
+    if not question:
+        raise ValueError("missing 'question'")
+    max_new_tokens = int(record.pop('max_new_tokens', None) or default_max_new_tokens)
+    return {**record, 'question': question}, max_new_tokens
+
+class Server:
+    """Feeds requests from any number of producers into one ContinuousBatcher"""
+
+    def __init__(self, batcher, output_file, max_new_tokens):
+        self.batcher = batcher
+        self.output_file = output_file
+        self.max_new_tokens = max_new_tokens
+        self.queue = asyncio.Queue()
+        self.counter = itertools.count(1)
+        self.results = []
+        # The model runs on one thread so the event loop stays free for I/O
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, line):
+        """Queue one JSONL line; returns a future for its result row"""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            record, max_new_tokens = parse_request(line, self.max_new_tokens)
+        except (ValueError, TypeError) as e:
+            request = ServeRequest({'request_id': next(self.counter), 'question': None}, 0, future)
+            request.error = f"invalid request: {e}"
+            self.finish(request)
+            return future
+
+        # Requests without an id of their own are numbered in arrival order
+        if 'request_id' not in record:
+            record = {'request_id': record.get('question_id', record.get('id')) or next(self.counter), **record}
+        self.queue.put_nowait(ServeRequest(record, max_new_tokens, future))
+        return future
+
+    def finish(self, request):
+        """Write a finished request's result and hand it to whoever is waiting for it"""
+        row = request.result(self.batcher.tokenizer)
+        bench.append_results(self.output, [row])
+        self.results.append(row)
+        print(f"✓ {row['request_id']}: {row['generated_tokens']} tokens "
+              f"in {row['total_s']:.2f}s ({len(self.batcher.active)} active, {self.queue.qsize()} queued)")
+        if request.future is not None and not request.future.done():
+            request.future.set_result(row)
+
+    async def schedule(self):
+        """Admit queued requests into free slots and step the batch until told to stop"""
+        loop = asyncio.get_running_loop()
+        draining = False
+
+        while not (draining and not self.batcher.active and self.queue.empty()):
+            admitted = []
+            if not self.batcher.active:
+                request = await self.queue.get()
+                if request is None:
+                    draining = True
+                    continue
+                admitted.append(request)
+            while len(admitted) < self.batcher.free_slots() and not self.queue.empty():
+                request = self.queue.get_nowait()
+                if request is None:
+                    draining = True
+                else:
+                    admitted.append(request)
+
+            try:
+                finished = await loop.run_in_executor(self.executor, self.batcher.run, admitted)
+            except Exception as e:
+                print(f"❌ Error in decode step: {e}")
+                finished = self.batcher.abort(str(e))
+                for request in admitted:
+                    if request.finished is None:
+                        request.error, request.finished = str(e), time.perf_counter()
+                        finished.append(request)
+
+            for request in finished:
+                self.finish(request)
+
+    async def read_file(self, path, follow=False):
+        """Submit every line of a JSONL file; with follow, keep reading lines appended later"""
+        buffer = ""
+        with open(path, 'r', encoding='utf-8') as f:
+            while True:
+                line = f.readline()
+                buffer += line
+                # With follow, a partial last line waits until its writer finishes it
+                if buffer.endswith("\n") or (buffer and not line and not follow):
+                    if buffer.strip():
+                        self.submit(buffer)
+                    buffer = ""
+                    await asyncio.sleep(0)
+                elif not line:
+                    if not follow:
+                        return
+                    await asyncio.sleep(0.2)
+
+    async def read_stdin(self):
+        """Submit JSONL lines from stdin until it closes"""
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                return
+            if line.strip():
+                self.submit(line)
+
+    async def handle_client(self, reader, writer):
+        """Socket producer: every JSONL line a client sends is answered on the same connection"""
+        pending = set()
+
+        async def reply(future):
+            row = await future
+            writer.write((json.dumps(row, ensure_ascii=False, default=str) + "\n").encode('utf-8'))
+            await writer.drain()
+
+        try:
+            async for line in reader:
+                if line.strip():
+                    pending.add(asyncio.ensure_future(reply(self.submit(line.decode('utf-8')))))
+            await asyncio.gather(*pending)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, input_path=None, follow=False, socket_path=None):
+        """Run until every finite source is exhausted (or forever while listening on a socket)"""
+        with open(self.output_file, 'a', encoding='utf-8') as self.output:
+            scheduler = asyncio.ensure_future(self.schedule())
+
+            producers = []
+            if input_path == "-":
+                producers.append(self.read_stdin())
+            elif input_path is not None:
+                producers.append(self.read_file(input_path, follow))
+
+            server = None
+            if socket_path is not None:
+                if os.path.exists(socket_path):
+                    os.remove(socket_path)
+                server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+                print(f"🔌 Listening on {socket_path}")
+
+            try:
+                await asyncio.gather(*producers)
+                if server is not None:
+                    await server.serve_forever()
+            finally:
+                if server is not None:
+                    server.close()
+                    os.remove(socket_path)
+                # Let everything already queued finish
+                self.queue.put_nowait(None)
+                await scheduler
+                self.executor.shutdown()
+
+def summarize(results, wall_time):
+    """Print latency percentiles and throughput of the served requests"""
+    served = [row for row in results if not str(row['response']).startswith("Error:")]
+    print(f"\n📊 Served {len(served)} requests ({len(results) - len(served)} errors) in {wall_time:.1f}s")
+    if not served:
+        return
+
+    def percentile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    for column in ('queue_s', 'ttft_s', 'total_s'):
+        values = [row[column] for row in served]
+        print(f"⏱️  {column}: p50 {statistics.median(values):.3f}  p95 {percentile(values, 0.95):.3f}  "
+              f"p99 {percentile(values, 0.99):.3f}")
+    generated = sum(row['generated_tokens'] for row in served)
+    print(f"📈 Generated {generated} tokens: {generated / wall_time:.1f} tokens/sec overall")
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Serve Gemma-3 270M with continuous batching over JSONL requests")
+    parser.add_argument("--input", default=None,
+                        help="JSONL file of requests, or '-' for stdin "
+                             "(fields: question, optional request_id and max_new_tokens)")
+    parser.add_argument("--follow", action="store_true", help="Keep reading lines appended to --input")
+    parser.add_argument("--socket", default=None,
+                        help="Also accept JSONL requests on this Unix socket; results go back on the connection")
+    parser.add_argument("--output", default="serve_results.jsonl", help="JSONL file every result is appended to")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Requests decoded together")
+    parser.add_argument("--max-new-tokens", type=int, default=bench.GENERATION_KWARGS['max_new_tokens'],
+                        help="Default for requests that don't set max_new_tokens")
+    parser.add_argument("--system-prompt", nargs="?", const=bench.SYSTEM_PROMPT, default=None,
+                        help=f"Instruction placed at the start of every user turn (bare flag: '{bench.SYSTEM_PROMPT}')")
+    parser.add_argument("--stop", action="append", default=[],
+                        help="Extra stop string (repeatable); generation always stops at <end_of_turn> and EOS")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for sampling")
+    args = parser.parse_args(argv)
+    if args.input is None and args.socket is None:
+        parser.error("give --input and/or --socket")
+    return args
+
+def main():
+    """Main function"""
+    args = parse_args()
+    bench.STOP_STRINGS[:] = args.stop
+
+    print("🚀 Gemma-3 270M GGUF Serving Mode (continuous batching)")
+    print("=" * 50)
+
+    if not bench.check_requirements():
+        return
+
+    model, tokenizer = bench.setup_gemma3_model()
+    if model is None or tokenizer is None:
+        print("❌ Failed to load model. Exiting.")
+        return
+
+    if args.seed is not None:
+        import torch
+        torch.manual_seed(args.seed)
+
+    batcher = ContinuousBatcher(model, tokenizer, args.system_prompt, args.max_batch_size)
+    server = Server(batcher, args.output, args.max_new_tokens)
+    print(f"✓ Ready: up to {args.max_batch_size} requests per batch, results appended to {args.output}")
+
+    start = time.perf_counter()
+    try:
+        asyncio.run(server.serve(args.input, args.follow, args.socket))
+    except KeyboardInterrupt:
+        print("\n⏹️  Stopped")
+
+    summarize(server.results, time.perf_counter() - start)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -33,7 +33,7 @@ pip install torch torchvision torchaudio
 
 # Install other requirements
 echo "🔄 Installing other dependencies..."
-pip install transformers>=4.36.0
+pip install "transformers>=5.19.0"
 pip install pandas>=1.5.0
 pip install datasets>=2.14.0
 pip install accelerate>=0.25.0
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Multi-model / multi-config sweep for the Saudi LLMs benchmark
+Runs every (model, generation config) pair of a sweep spec on one copy of the dataset,
+keeping loaded models resident within a per-device memory budget and evicting the least
+recently used ones when a new model doesn't fit
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import gemma3_saudi_benchmark as bench
+
+EXAMPLE_SPEC = {
+    "memory_budget_mb": {"cpu": 8192, "cuda": 20000},
+    "system_prompt": bench.SYSTEM_PROMPT,
+    "models": [
+        {"name": "gemma3-4bit", "loader": "unsloth_4bit"},
+        {"name": "gemma3-cpu-int8", "loader": "cpu", "options": {"int8": True, "compile": True}},
+        {"name": "mock", "loader": "mock", "options": {"token_latency": 0.001}},
+    ],
+    "generation": [
+        {"name": "default"},
+        {"name": "greedy", "do_sample": False},
+        {"name": "short-batched", "max_new_tokens": 64, "batch_size": 8},
+    ],
+}
+
+# Generation config keys that are run_benchmark options rather than GENERATION_KWARGS
+RUN_OPTIONS = ('batch_size', 'samples_per_question', 'prompt_lookup')
+
+def load_spec(path):
+    """Read a sweep spec (JSON) and fill in the defaults"""
+    with open(path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+
+    models = spec.get('models') or []
+    if not models:
+        raise ValueError(f"{path} lists no models")
+    loaders = ['auto'] + [name for name, _, _ in bench.model_loaders()] + ['cpu', 'mock']
+    for entry in models:
+        entry.setdefault('loader', 'auto')
+        entry.setdefault('options', {})
+        entry.setdefault('name', entry.get('model', entry['loader']))
+        if entry['loader'] not in loaders:
+            raise ValueError(f"Unknown loader {entry['loader']!r} for model {entry['name']!r}; "
+                             f"expected one of {', '.join(loaders)}")
+
+    spec['generation'] = spec.get('generation') or [{'name': 'default'}]
+    known = set(bench.GENERATION_KWARGS) | set(RUN_OPTIONS) | {'name'}
+    for i, entry in enumerate(spec['generation']):
+        entry.setdefault('name', f"gen{i}")
+        # Caught here rather than when the run comes up, hours into the sweep
+        unknown = sorted(set(entry) - known)
+        if unknown:
+            raise ValueError(f"Unknown setting(s) {unknown} in generation config {entry['name']!r}; "
+                             f"expected name, {', '.join(sorted(known - {'name'}))}")
+
+    for kind in ('models', 'generation'):
+        names = [entry['name'] for entry in spec[kind]]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Duplicate {kind} names in {path}: {names}")
+    return spec
+
+def schedule(spec):
+    """Order the (model, generation) runs so every model is loaded once and then used for all its configs"""
+    return [(model, generation) for model in spec['models'] for generation in spec['generation']]
+
+def model_footprint_mb(model):
+    """Memory held by a model's weights and buffers per device type, e.g. {'cpu': 540.0}"""
+    import torch
+
+    footprint = {}
+    seen = set()
+    for value in model.state_dict().values():
+        # Dynamically quantized layers store (weight, bias) tuples
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if not torch.is_tensor(tensor):
+                continue
+            key = (tensor.device.type, tensor.data_ptr())
+            if key in seen:  # Tied weights
+                continue
+            seen.add(key)
+            footprint[tensor.device.type] = (footprint.get(tensor.device.type, 0.0)
+                                             + tensor.numel() * tensor.element_size() / (1024 * 1024))
+    return footprint
+
+def load_model(entry):
+    """Load a spec's model entry; returns (model, tokenizer, backend)"""
+    loader = entry['loader']
+    options = entry['options']
+
+    if loader == 'mock':
+        from run_benchmark_demo import MockBackend
+        return None, None, MockBackend(**options)
+
+    if loader == 'cpu':
+        model, tokenizer = bench.setup_cpu_model(model_name=entry.get('model', bench.CPU_MODEL_NAME), **options)
+    else:
+        model_name = entry.get('model', bench.MODEL_NAME)
+        model, tokenizer = bench.setup_gemma3_model(
+            manifest_path=bench.LOADER_MANIFEST if loader == 'auto' else None,
+            model_name=model_name,
+            loader=None if loader == 'auto' else loader,
+        )
+
+    if model is None or tokenizer is None:
+        raise RuntimeError(f"could not load {entry['name']}")
+    return model, tokenizer, None
+
+class ModelPool:
+    """Loaded models in least-recently-used order, kept within a per-device memory budget
+
+    budget maps a device type to MB (e.g. {'cpu': 8192, 'cuda': 20000}); devices without
+    an entry are unlimited. Models whose tokenizers are identical share one tokenizer object.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget or {}
+        self.resident = OrderedDict()  # name -> (model, tokenizer, backend, footprint)
+        self.footprints = {}           # name -> last measured footprint, kept after eviction
+        self.tokenizers = {}           # tokenizer fingerprint -> shared tokenizer
+        self.loads = 0
+        self.evictions = 0
+
+    def used(self, exclude=None):
+        used = {}
+        for name, (_, _, _, footprint) in self.resident.items():
+            if name == exclude:
+                continue
+            for device, mb in footprint.items():
+                used[device] = used.get(device, 0.0) + mb
+        return used
+
+    def fits(self, footprint, exclude=None):
+        used = self.used(exclude)
+        return all(used.get(device, 0.0) + footprint.get(device, 0.0) <= limit
+                   for device, limit in self.budget.items())
+
+    def evict(self, name):
+        self.resident.pop(name)
+        self.evictions += 1
+        # Drop the last references before the next model is loaded
+        gc.collect()
+        if 'torch' in sys.modules:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        print(f"♻️  Evicted {name}")
+
+    def make_room(self, footprint, keep=None):
+        """Evict least recently used models until footprint fits next to the rest"""
+        for name in list(self.resident):
+            if self.fits(footprint, exclude=keep):
+                break
+            if name != keep:
+                self.evict(name)
+
+    def expected_footprint(self, entry):
+        if entry['name'] in self.footprints:
+            return self.footprints[entry['name']]
+        memory_mb = entry.get('memory_mb')
+        if isinstance(memory_mb, dict):
+            return memory_mb
+        if memory_mb is not None:
+            return {device: memory_mb for device in self.budget}
+        # Unknown size: assume it is as large as the largest model seen so far
+        known = list(self.footprints.values())
+        return {device: max(f.get(device, 0.0) for f in known) for device in self.budget} if known else {}
+
+    def get(self, entry):
+        """(model, tokenizer, backend, load seconds) for a model entry, loading it if needed"""
+        name = entry['name']
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            model, tokenizer, backend, _ = self.resident[name]
+            return model, tokenizer, backend, 0.0
+
+        self.make_room(self.expected_footprint(entry))
+        start = time.perf_counter()
+        model, tokenizer, backend = load_model(entry)
+        load_s = time.perf_counter() - start
+        self.loads += 1
+
+        if tokenizer is not None:
+            from prompt_store import tokenizer_fingerprint
+            tokenizer = self.tokenizers.setdefault(tokenizer_fingerprint(tokenizer), tokenizer)
+
+        footprint = model_footprint_mb(model) if model is not None else {}
+        self.footprints[name] = footprint
+        self.resident[name] = (model, tokenizer, backend, footprint)
+        print(f"📋 {name} holds {', '.join(f'{mb:.0f} MB {device}' for device, mb in footprint.items()) or 'no weights'}")
+
+        # The estimate may have been too low
+        self.make_room({}, keep=name)
+        if not self.fits({}):
+            print(f"⚠️  {name} alone exceeds the memory budget {self.budget}")
+        return model, tokenizer, backend, load_s
+
+def summarize_run(label, model_entry, generation_entry, results_df, run_s, load_s, output_file):
+    """One comparison-table row for a finished run"""
+    timed = results_df[results_df['total_s'].notna()] if 'total_s' in results_df.columns else results_df.iloc[0:0]
+    generated = timed['generated_tokens'].sum() if len(timed) else 0
+    return {
+        'config': label,
+        'model': model_entry['name'],
+        'generation': generation_entry['name'],
+        'questions': results_df['question_id'].nunique(),
+        'errors': int(results_df['response'].astype(str).str.startswith("Error:").sum()),
+        'generated_tokens': int(generated),
+        'load_s': load_s,
+        'run_s': run_s,
+        'tokens_per_s': generated / run_s if run_s else None,
+        'decode_tokens_per_s_p50': timed['decode_tokens_per_s'].median() if len(timed) else None,
+        'ttft_p50_s': timed['ttft_s'].median() if len(timed) else None,
+        'latency_p50_s': timed['total_s'].median() if len(timed) else None,
+        'latency_p95_s': timed['total_s'].quantile(0.95) if len(timed) else None,
+        'peak_rss_mb': timed['peak_rss_mb'].max() if len(timed) else None,
+        'output_file': output_file,
+    }
+
+def run_sweep(spec, questions_df, output_dir, resume=False, cache=None, seed=None, prompt_store=True):
+    """Run every (model, generation config) pair of the spec; returns the comparison table"""
+    import pandas as pd
+
+    os.makedirs(output_dir, exist_ok=True)
+    runs = schedule(spec)
+    pool = ModelPool(spec.get('memory_budget_mb'))
+    system_prompt = spec.get('system_prompt')
+    # Shared by every model with the same tokenizer, so each tokenizer encodes the dataset once
+    store_root = os.path.join(output_dir, ".prompt_store") if prompt_store else None
+
+    print(f"🔄 Sweeping {len(spec['models'])} models x {len(spec['generation'])} generation configs "
+          f"= {len(runs)} runs on {len(questions_df)} questions")
+    summary = []
+
+    for i, (model_entry, generation_entry) in enumerate(runs):
+        label = f"{model_entry['name']}__{generation_entry['name']}"
+        output_file = os.path.join(output_dir, f"{label}.csv")
+        print(f"\n🎯 Run {i + 1}/{len(runs)}: {label}")
+
+        try:
+            model, tokenizer, backend, load_s = pool.get(model_entry)
+        except Exception as e:
+            print(f"❌ Skipping {label}: {e}")
+            summary.append({'config': label, 'model': model_entry['name'], 'generation': generation_entry['name'],
+                            'errors': len(questions_df), 'output_file': None})
+            continue
+
+        settings = {key: value for key, value in generation_entry.items()
+                    if key != 'name' and key not in RUN_OPTIONS}
+        run_options = {key: generation_entry[key] for key in RUN_OPTIONS if key in generation_entry}
+
+        start = time.perf_counter()
+        with bench.generation_overrides(**settings):
+            results_df = bench.run_benchmark(model, tokenizer, questions_df, output_file, resume=resume, cache=cache,
+                                             seed=seed, system_prompt=system_prompt, backend=backend,
+                                             prompt_store=store_root if backend is None else None, **run_options)
+        run_s = time.perf_counter() - start
+
+        summary.append(summarize_run(label, model_entry, generation_entry, results_df, run_s, load_s, output_file))
+
+    print(f"\n✓ {pool.loads} model loads, {pool.evictions} evictions")
+    return pd.DataFrame(summary)
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Run a matrix of models and generation configs on the benchmark")
+    parser.add_argument("spec", nargs="?", help="Sweep spec (JSON); see --example")
+    parser.add_argument("--example", action="store_true", help="Print an example sweep spec and exit")
+    parser.add_argument("--csv", default=bench.DEFAULT_CSV_PATH, help="Path to the benchmark questions CSV")
+    parser.add_argument("--categories", default=None, help="Comma-separated question categories to run")
+    parser.add_argument("--output-dir", default="sweep_results", help="Directory for per-config results")
+    parser.add_argument("--resume", action="store_true", help="Carry on with runs that were interrupted")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for sampling")
+    parser.add_argument("--cache", default="gemma3_cache.sqlite", help="Response cache database")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache entirely")
+    parser.add_argument("--no-prompt-store", action="store_true",
+                        help="Tokenize prompts on the fly instead of sharing a pre-tokenized store")
+    args = parser.parse_args()
+
+    if args.example:
+        print(json.dumps(EXAMPLE_SPEC, ensure_ascii=False, indent=2))
+        return 0
+    if args.spec is None:
+        parser.error("a sweep spec is required (see --example)")
+
+    print("🚀 Gemma-3 Saudi LLMs Benchmark Sweep")
+    print("=" * 50)
+
+    try:
+        spec = load_spec(args.spec)
+    except (OSError, ValueError) as e:
+        print(f"❌ Could not read sweep spec: {e}")
+        return 1
+
+    # Loaded once for every run
+    questions_df = bench.load_benchmark_data(args.csv,
+                                             categories=args.categories.split(",") if args.categories else None)
+    if questions_df is None:
+        return 1
+
+    cache = None if args.no_cache else bench.ResponseCache(args.cache)
+    try:
+        summary_df = run_sweep(spec, questions_df, args.output_dir, resume=args.resume, cache=cache, seed=args.seed,
+                               prompt_store=not args.no_prompt_store)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    summary_path = os.path.join(args.output_dir, "sweep_summary.csv")
+    summary_df.to_csv(summary_path, index=False)
+
+    print("=" * 50)
+    columns = ['config', 'questions', 'errors', 'generated_tokens', 'load_s', 'run_s', 'tokens_per_s',
+               'decode_tokens_per_s_p50', 'ttft_p50_s', 'latency_p95_s', 'peak_rss_mb']
+    print(summary_df.reindex(columns=columns).round(2).to_string(index=False))
+    print(f"\n📁 Comparison table saved to {summary_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
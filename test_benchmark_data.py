@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the shared question loader and its Parquet cache
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from benchmark_data import columnar_cache_path, iter_question_records, load_questions
+
+def write_questions(path, rows=50000):
+    # Quoted multi-line questions straddle the CSV reader's block boundaries
+    pd.DataFrame({
+        'question_id': [f"{i:05d}" for i in range(rows)],
+        'question_category': ['history' if i % 3 else 'coding' for i in range(rows)],
+        'question': [f"السؤال رقم {i}\nاكتب الجواب في سطر\n\"ثالث\"" for i in range(rows)],
+    }).to_csv(path, index=False)
+    return pd.read_csv(path, dtype=str)
+
+def test_multiline_questions(tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "questions.csv")
+    expected = write_questions(path)
+
+    loaded = load_questions(path)
+    assert os.path.exists(columnar_cache_path(path))
+    pd.testing.assert_frame_equal(loaded, expected, check_dtype=False)
+    # Ids keep their leading zeros
+    assert loaded['question_id'][0] == "00000"
+    # No temporary files are left next to the cache
+    assert os.listdir(os.path.dirname(columnar_cache_path(path))) == ["questions.parquet"]
+
+def test_filters(tmp_path):
+    path = str(tmp_path / "questions.csv")
+    write_questions(path, rows=30)
+    coding = load_questions(path, categories=['coding'])
+    assert set(coding['question_category']) == {'coding'} and len(coding) == 10
+    records = list(iter_question_records(path, question_ids=['00003', '00004']))
+    assert [r['question_id'] for r in records] == ['00003', '00004']
+
+def test_corrupt_cache_is_rebuilt(tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "questions.csv")
+    expected = write_questions(path, rows=100)
+    cache_path = columnar_cache_path(path)
+    os.makedirs(os.path.dirname(cache_path))
+    with open(cache_path, 'wb') as f:
+        f.write(b"not parquet")
+
+    pd.testing.assert_frame_equal(load_questions(path), expected, check_dtype=False)
+
+def test_falls_back_to_csv_when_cache_is_unwritable(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    import benchmark_data
+
+    path = str(tmp_path / "questions.csv")
+    expected = write_questions(path, rows=100)
+
+    def read_only(*args, **kwargs):
+        raise PermissionError(13, "Permission denied")
+    monkeypatch.setattr(benchmark_data.os, "makedirs", read_only)
+
+    pd.testing.assert_frame_equal(load_questions(path), expected, check_dtype=False)
+    assert not os.path.exists(columnar_cache_path(path))
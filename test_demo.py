@@ -6,16 +6,18 @@ Demo script to test the benchmark loading without requiring the full model
 import pandas as pd
 import os
 
-def test_benchmark_loading():
-    """Test loading the benchmark data"""
-    csv_path = "Pico-Saudi-LLMs-Benchmark/v0.01/Pico-Saudi-LLMs-Questions-v0.01.csv"
-    
+from benchmark_data import load_questions
+
+BENCHMARK_CSV = "Pico-Saudi-LLMs-Benchmark/v0.01/Pico-Saudi-LLMs-Questions-v0.01.csv"
+
+def load_benchmark(csv_path=BENCHMARK_CSV):
+    """Load the benchmark data and print a summary, returning it on success"""
     if not os.path.exists(csv_path):
         print(f"❌ Benchmark file not found: {csv_path}")
-        return False
+        return None
     
     try:
-        df = pd.read_csv(csv_path)
+        df = load_questions(csv_path)
         print(f"✓ Loaded {len(df)} questions from benchmark dataset")
         
         # Display dataset info
@@ -32,11 +34,21 @@ def test_benchmark_loading():
             print(f"\n{idx + 1}. Category: {row['question_category']}")
             print(f"   Question: {row['question']}")
         
-        return True
+        return df
         
     except Exception as e:
         print(f"❌ Error loading benchmark: {e}")
-        return False
+        return None
+
+def test_benchmark_loading():
+    """Test loading the benchmark data"""
+    import pytest
+    
+    if not os.path.exists(BENCHMARK_CSV):
+        pytest.skip(f"Benchmark file not found: {BENCHMARK_CSV}")
+    df = load_benchmark()
+    assert df is not None and len(df) > 0
+    assert {'question_id', 'question_category', 'question'} <= set(df.columns)
 
 def simulate_model_responses(df):
     """Simulate model responses for testing"""
@@ -69,9 +81,8 @@ def main():
     print("🎯 Gemma-3 270M GGUF Saudi Benchmark Demo")
     print("=" * 40)
     
-    # Test benchmark loading
-    csv_path = "Pico-Saudi-LLMs-Benchmark/v0.01/Pico-Saudi-LLMs-Questions-v0.01.csv"
-    df = pd.read_csv(csv_path) if test_benchmark_loading() else None
+    # Test benchmark loading (the loaded questions are reused below)
+    df = load_benchmark()
     
     if df is not None:
         # Simulate responses
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the shared-prefix KV cache, on a tiny randomly initialised Gemma-3 (no download)
+"""
+
+import csv
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from gemma3_saudi_benchmark import PrefixCache, generate_batch_responses, generation_overrides
+
+DEMO_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gemma3_results_demo.csv")
+
+def tiny_model(sliding_window):
+    """Word-level tokenizer over the demo questions and a 2-layer Gemma-3 with the given window"""
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import Gemma3ForCausalLM, Gemma3TextConfig, PreTrainedTokenizerFast
+
+    with open(DEMO_RESULTS, encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    words = sorted({word for row in rows for word in (row['question'] + " " + row['response']).split()})
+    specials = ['<pad>', '<eos>', '<bos>', '<unk>', '<start_of_turn>', '<end_of_turn>']
+    vocab = {token: i for i, token in enumerate(specials + ['user', 'model'] + words)}
+
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token='<unk>'))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    backend.post_processor = processors.TemplateProcessing(single='<bos> $A', special_tokens=[('<bos>', 2)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token='<bos>', eos_token='<eos>',
+                                        pad_token='<pad>', unk_token='<unk>',
+                                        additional_special_tokens=['<start_of_turn>', '<end_of_turn>'])
+
+    torch.manual_seed(0)
+    config = Gemma3TextConfig(vocab_size=len(vocab), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                              num_attention_heads=2, num_key_value_heads=1, head_dim=32,
+                              sliding_window=sliding_window, pad_token_id=0, eos_token_id=1, bos_token_id=2)
+    return Gemma3ForCausalLM(config).eval(), tokenizer, [row['question'] for row in rows]
+
+@pytest.mark.parametrize("sliding_window", [512, 6])
+def test_prefix_cache_matches_uncached_batches(sliding_window):
+    model, tokenizer, questions = tiny_model(sliding_window)
+    # Different lengths, so rows of a batch are padded
+    batch = sorted(questions[:8], key=len)[::3]
+    prefix_cache = PrefixCache(model, tokenizer)
+
+    with generation_overrides(do_sample=False, max_new_tokens=12):
+        uncached = generate_batch_responses(model, tokenizer, batch)
+        cached = generate_batch_responses(model, tokenizer, batch, prefix_cache=prefix_cache)
+    assert cached == uncached
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the columnar results store, on the runner's real output (mock backend, no model)
+"""
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from gemma3_saudi_benchmark import run_benchmark
+from results_store import category_stats, export_results, list_runs, write_run
+from run_benchmark_demo import MockBackend
+
+QUESTIONS = pd.DataFrame({
+    'question_id': ['a1', 'b2', 'c3', 'd4'],
+    'question_category': ['history', 'history', 'reasoning', 'coding'],
+    'question': ['متى تأسست المملكة؟', 'من هو مؤسس الدولة؟', 'ما هو مربع 7؟', 'اكتب دالة'],
+})
+
+def runner_output(tmp_path, questions=QUESTIONS):
+    output_file = str(tmp_path / "results.csv")
+    return run_benchmark(None, None, questions, output_file, backend=MockBackend(), cache=None), output_file
+
+def test_stats_across_runs(tmp_path):
+    results, _ = runner_output(tmp_path)
+    store = str(tmp_path / "store")
+    write_run(results, store, run_id="a", model="mock")
+    # A second run whose files have a different category dictionary
+    write_run(results[results['question_category'] != 'history'], store, run_id="b", model="mock")
+
+    stats = category_stats(store)
+    assert set(zip(stats['run_id'], stats['question_category'])) == {
+        ('a', 'history'), ('a', 'reasoning'), ('a', 'coding'), ('b', 'reasoning'), ('b', 'coding')}
+    assert stats.loc[stats['question_category'] == 'history', 'results'].tolist() == [2]
+
+    filtered = category_stats(store, runs=['a', 'b'], categories=['coding'])
+    assert filtered['results'].tolist() == [1, 1]
+    assert list_runs(store)['results'].tolist() == [4, 2]
+
+@pytest.mark.parametrize("extension", [".csv", ".jsonl"])
+def test_add_runner_files(tmp_path, extension):
+    _, output_file = runner_output(tmp_path)
+    path = output_file.replace(".csv", extension)
+    results = (pd.read_json(path, lines=True, dtype={'question_id': str}) if extension == ".jsonl"
+               else pd.read_csv(path, dtype={'question_id': str}))
+    store = str(tmp_path / "store")
+    write_run(results, store, run_id="run", model="mock")
+
+    exported = str(tmp_path / "export.csv")
+    export_results(exported, store)
+    stored = pd.read_csv(exported, dtype={'question_id': str})
+    assert sorted(stored['question_id']) == sorted(QUESTIONS['question_id'])
+    assert stored['timestamp'].notna().all()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the benchmark runner (results stream, resume), using the mock backend
+"""
+
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from gemma3_saudi_benchmark import parse_args, results_stream_path, run_benchmark, run_benchmark_parallel
+from run_benchmark_demo import MockBackend
+
+QUESTIONS = pd.DataFrame({
+    'question_id': [f"q{i}" for i in range(6)],
+    'question_category': ['history', 'culture', 'reasoning', 'coding', 'history', 'media'],
+    'question': ['متى تأسست المملكة؟', 'ما هي العرضة؟', 'ما هو مربع 7؟', 'اكتب دالة', 'من هو المؤسس؟', 'ما هي قناة الإخبارية؟'],
+})
+
+class RecordingBackend(MockBackend):
+    """MockBackend that remembers which questions it generated"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.generated = []
+
+    def generate_batch(self, questions, prefill_rows=None):
+        self.generated.extend(q['question_id'] for q in questions)
+        return super().generate_batch(questions, prefill_rows)
+
+def test_resume_skips_unreadable_lines(tmp_path):
+    output_file = str(tmp_path / "results.csv")
+    run_benchmark(None, None, QUESTIONS, output_file, backend=MockBackend(), cache=None, batch_size=4)
+
+    # A failed question plus lines that aren't results (e.g. a torn or foreign write)
+    stream_path = results_stream_path(output_file)
+    rows = [json.loads(line) for line in open(stream_path, encoding='utf-8')]
+    rows[2]['response'] = "Error: out of memory"
+    with open(stream_path, 'w', encoding='utf-8') as f:
+        f.write("question_id,question_category,question\n")
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        f.write("not json\n")
+
+    backend = RecordingBackend()
+    results = run_benchmark(None, None, QUESTIONS, output_file, backend=backend, cache=None, resume=True)
+    assert backend.generated == [rows[2]['question_id']]
+    assert results['question_id'].tolist() == QUESTIONS['question_id'].tolist()
+    assert not results['response'].str.startswith("Error:").any()
+
+def test_jsonl_output_is_rejected(tmp_path):
+    with pytest.raises(SystemExit):
+        parse_args(["--output", "results.jsonl"])
+    with pytest.raises(ValueError):
+        run_benchmark(None, None, QUESTIONS, str(tmp_path / "results.jsonl"), backend=MockBackend(), cache=None)
+
+class DyingBackend(MockBackend):
+    """MockBackend whose worker process dies on one question"""
+
+    def generate_batch(self, questions, prefill_rows=None):
+        if any(q['question_id'] == "q4" for q in questions):
+            os._exit(3)
+        return super().generate_batch(questions, prefill_rows)
+
+def test_dead_worker_rows_are_stored_once(tmp_path):
+    output_file = str(tmp_path / "results.csv")
+    results = run_benchmark_parallel(QUESTIONS, output_file, num_workers=2, threads_per_worker=1, shard_size=2,
+                                     backend=DyingBackend())
+
+    assert sorted(results['question_id']) == sorted(QUESTIONS['question_id'])
+    stream = [json.loads(line) for line in open(results_stream_path(output_file), encoding='utf-8')]
+    assert len(stream) == len({row['question_id'] for row in stream})
+    # Messages the dying worker hadn't flushed are lost too, but never more than its own questions
+    errors = set(results.loc[results['response'].str.startswith("Error:"), 'question_id'])
+    assert "q4" in errors and len(errors) < len(QUESTIONS)
+
+def test_token_budgets_cap_generated_tokens(tmp_path):
+    budgets = {'history': 4, 'culture': 4}
+    results = run_benchmark(None, None, QUESTIONS, str(tmp_path / "results.csv"), backend=MockBackend(), cache=None,
+                            batch_size=4, token_budgets=budgets)
+
+    capped = results['question_category'].isin(budgets)
+    assert (results.loc[capped, 'max_new_tokens'] == 4).all()
+    assert (results.loc[capped, 'generated_tokens'] == 4).all()
+    assert (results.loc[~capped, 'generated_tokens'] < results.loc[~capped, 'max_new_tokens']).all()
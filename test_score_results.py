@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the scoring stage, run on the runner's real output (mock backend, no model)
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from gemma3_saudi_benchmark import run_benchmark
+from run_benchmark_demo import MockBackend
+from score_results import run_sandboxed, score_results, text_scores
+
+ANSWER_KEY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_answer_key.csv")
+
+QUESTIONS = pd.DataFrame({
+    'question_id': ['a1', '2655d', 'fdb6a'],
+    'question_category': ['history', 'reasoning', 'coding'],
+    'question': ['متى تأسست المملكة؟', 'ما هو مربع 7؟', 'اكتب برنامجاً يجمع الأعداد من 1 إلى n'],
+})
+
+def runner_output(tmp_path):
+    """Results CSV (and its JSONL stream) written by run_benchmark"""
+    output_file = str(tmp_path / "results.csv")
+    results = run_benchmark(None, None, QUESTIONS, output_file, backend=MockBackend(), cache=None)
+    assert 'max_new_tokens' in results.columns
+    return results, output_file
+
+@pytest.mark.parametrize("extension", [".csv", ".jsonl"])
+def test_scores_runner_output(tmp_path, extension):
+    results, output_file = runner_output(tmp_path)
+    path = os.path.splitext(output_file)[0] + extension
+    summary = score_results(path, str(tmp_path / "scores.csv"), ANSWER_KEY, workers=2)
+
+    assert summary is not None and summary['responses'].sum() == len(QUESTIONS)
+    scores = pd.read_csv(tmp_path / "scores.csv", dtype={'question_id': str})
+    expected = results.set_index('question_id')
+    truncated = expected['generated_tokens'] >= expected['max_new_tokens']
+    assert scores.set_index('question_id')['truncated'].astype(bool).equals(truncated.loc[scores['question_id']])
+
+def test_scores_store_run(tmp_path):
+    pytest.importorskip("pyarrow")
+    from results_store import write_run
+
+    results, _ = runner_output(tmp_path)
+    store = str(tmp_path / "store")
+    run_id = write_run(results, store, run_id="test", model="mock")
+    summary = score_results(store=store, runs=[run_id], output_file=str(tmp_path / "scores.csv"),
+                            answer_key_path=ANSWER_KEY, workers=2)
+    assert summary['responses'].sum() == len(QUESTIONS)
+
+def test_truncated_uses_each_rows_budget():
+    scores = text_scores(["نص", "نص", "نص"], [16, 16, None], pd.Series([16, 256, 16]))
+    assert scores['truncated'].tolist() == [True, False, pd.NA]
+
+def test_code_is_checked_against_expected_output():
+    code = "n = int(input())\nprint(sum(range(1, n + 1)))"
+    assert run_sandboxed(code, stdin="10", stdout="55")[0] == "passed"
+    assert run_sandboxed("input()\nprint(0)", stdin="10", stdout="55")[0] == "failed"
+    assert run_sandboxed("print(0)")[0] == "ran"